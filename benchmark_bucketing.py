@@ -0,0 +1,88 @@
+import argparse
+import gzip
+import logging
+import os
+import random
+import time
+
+import numpy as np
+
+from process_scraped_data import add_model_arguments, iter_json, tweet_text, load_model, predict, token_lengths
+
+logging.basicConfig(level=logging.INFO)
+transformers_logger = logging.getLogger("transformers")
+transformers_logger.setLevel(logging.WARNING)
+
+
+def sample_tweets(json_input, sample_size, seed, slovene_only=True, transform=None):
+    """Reservoir sample of (Slovene) tweets of json_input, transformed with transform if given.
+
+    The whole scraped data never has to be kept in memory.
+    """
+    rng = random.Random(seed)
+    tweets = []
+    seen = 0
+    for file in sorted(os.listdir(json_input)):
+        with gzip.open(os.path.join(json_input, file), 'rt', encoding='utf8') as json_in_f:
+            for tweet in iter_json(json_in_f):
+                if slovene_only and tweet['lang_z'] != 1:
+                    continue
+                seen += 1
+                if len(tweets) < sample_size:
+                    tweets.append(transform(tweet) if transform else tweet)
+                else:
+                    i = rng.randrange(seen)
+                    if i < sample_size:
+                        tweets[i] = transform(tweet) if transform else tweet
+    return tweets
+
+
+def sample_texts(args):
+    return sample_tweets(args.json_input, args.sample_size, args.manual_seed, transform=tweet_text)
+
+
+def run(model, texts, bucket_size, tokens_num):
+    start = time.time()
+    predictions = np.atleast_1d(predict(model, texts, bucket_size))
+    duration = time.time() - start
+    logging.info(f'bucket_size={bucket_size}: {duration:.2f}s - {tokens_num / duration:.1f} tokens/s - '
+                 f'{len(texts) / duration:.1f} tweets/s')
+    return predictions, duration
+
+
+def main(args):
+    texts = sample_texts(args)
+    model = load_model(args)
+    # only real (non-padding) tokens are counted
+    tokens_num = int(token_lengths(model, [text.lower() for text in texts]).sum())
+    logging.info(f'Benchmarking on {len(texts)} tweets with {tokens_num} tokens')
+
+    # warm up
+    predict(model, texts[:model.args.eval_batch_size])
+
+    unsorted_predictions, unsorted_duration = run(model, texts, 0, tokens_num)
+    bucketed_predictions, bucketed_duration = run(model, texts, args.bucket_size, tokens_num)
+    logging.info(f'Speedup: {unsorted_duration / bucketed_duration:.2f}x - max prediction difference: '
+                 f'{np.abs(unsorted_predictions - bucketed_predictions).max():.6f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare prediction throughput with and without length-bucketed batches.')
+    parser.add_argument('--json_input', default='data/json_data_input/',
+                        help='input folder with gz files')
+    parser.add_argument('--sample_size', type=int, default=5000,
+                        help='Number of Slovene tweets randomly sampled from json_input.')
+    parser.add_argument('--bucket_size', type=int, default=256,
+                        help='Bucket size used in the bucketed run.')
+    add_model_arguments(parser)
+    parser.add_argument('--manual_seed', type=int, default=23,
+                        help='manual seed')
+    args = parser.parse_args()
+    # remote and cascade models batch on their own, bucketing does not apply to them
+    if args.backend == 'remote' or args.cascade_model:
+        parser.error('bucketing is only benchmarked with the pytorch and onnx backends, without --cascade_model')
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))
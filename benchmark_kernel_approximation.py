@@ -0,0 +1,57 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+from scipy import stats
+
+from regression_svm import (MODELS, add_feature_arguments, add_kernel_approximation_arguments, load_features, read_data,
+                            seed)
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main(args):
+    train_df, eval_df = read_data(args.input)
+    X_train, X_test, _ = load_features(args, train_df, eval_df)
+    y_train = train_df['labels'].to_numpy()
+    y_true = eval_df['labels'].to_numpy()
+
+    results = []
+    for train_size in [int(size) for size in args.train_sizes.split(',')]:
+        train_size = min(train_size, X_train.shape[0])
+        indices = np.sort(np.random.RandomState(seed).choice(X_train.shape[0], train_size, replace=False))
+        X, y = X_train[indices], y_train[indices]
+        for name in args.models.split(','):
+            start = time.time()
+            model = MODELS[name](args, X).fit(X, y)
+            fit_time = time.time() - start
+            y_test = model.predict(X_test)
+            pearson = stats.pearsonr(y_test, y_true)[0]
+            spearman = stats.spearmanr(y_test, y_true)[0]
+            logging.info(f'{name} on {train_size} examples - fit {fit_time:.1f}s | Pearson: {pearson:.4f} | '
+                         f'Spearman: {spearman:.4f}')
+            results.append([name, str(train_size), f'{fit_time:.1f}', f'{pearson:.4f}', f'{spearman:.4f}'])
+
+    print('| model | train size | fit time (s) | Pearson Correlation | Spearman Correlation |')
+    print('| --- | --- | --- | --- | --- |')
+    for result in results:
+        print('| ' + ' | '.join(result) + ' |')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare wall time and correlation of exact SVR and its kernel approximations.')
+    parser.add_argument('input',
+                        help='Path to input files (as used by regression_svm).')
+    add_feature_arguments(parser)
+    parser.add_argument('--models', default='SVR_rbf,Nystroem_rbf,RFF_rbf,SVR_linear,LinearSVR',
+                        help=f'Comma separated models to compare, out of {",".join(MODELS)}.')
+    parser.add_argument('--train_sizes', default='1000,2000,5000,10000,20000',
+                        help='Comma separated numbers of training examples.')
+    add_kernel_approximation_arguments(parser)
+    args = parser.parse_args()
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))
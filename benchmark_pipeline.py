@@ -0,0 +1,229 @@
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from benchmark_bucketing import sample_tweets
+from process_scraped_data import (add_model_arguments, iter_json, tweet_text, load_model, predict, token_lengths,
+                                  AnnotationWriter)
+from run_records import peak_rss_mb
+
+logging.basicConfig(level=logging.INFO)
+transformers_logger = logging.getLogger("transformers")
+transformers_logger.setLevel(logging.WARNING)
+
+STAGES = ['decode', 'filter', 'normalize', 'tokenize', 'inference', 'serialize']
+SYNTHETIC_ALPHABET = 'abcdefghijklmnoprstuvzčšž'
+
+
+def synthetic_tweets(args):
+    rng = random.Random(args.manual_seed)
+    tweets = []
+    for i in range(args.synthetic):
+        words = [''.join(rng.choice(SYNTHETIC_ALPHABET) for _ in range(rng.randint(1, 10)))
+                 for _ in range(rng.randint(3, 40))]
+        # irregular whitespace, as in scraped tweets
+        text = ''.join(word + rng.choice([' ', ' ', ' ', '  ', '\n']) for word in words)
+        tweets.append({'id_str': str(10 ** 18 + i), 'created_at': 'Mon Jan 04 10:00:00 +0000 2021',
+                       'full_text': text, 'user': {'id_str': str(rng.randrange(10 ** 9)), 'screen_name': words[0]},
+                       'lang_z': int(rng.random() < args.slovene_ratio)})
+    return tweets
+
+
+class StageTimer(object):
+    """Collects per batch durations and tweet counts of pipeline stages."""
+    def __init__(self):
+        self.durations = {stage: [] for stage in STAGES}
+        self.tweets = {stage: 0 for stage in STAGES}
+
+    def time(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.durations[stage].append(time.perf_counter() - start)
+        return result
+
+    def count(self, stage, tweets_num):
+        self.tweets[stage] += tweets_num
+
+    def report(self):
+        results = {}
+        for stage in STAGES:
+            durations = np.array(self.durations[stage])
+            if not len(durations):
+                continue
+            total = float(durations.sum())
+            results[stage] = {
+                'tweets': self.tweets[stage],
+                'batches': len(durations),
+                'seconds': total,
+                'tweets_per_s': self.tweets[stage] / total if total > 0 else float('inf'),
+                'batch_latency_ms': {f'p{percentile}': float(np.percentile(durations, percentile)) * 1000
+                                     for percentile in [50, 90, 99]},
+            }
+        return results
+
+
+def next_batch(tweets_iterator, batch_size):
+    batch = []
+    for tweet in tweets_iterator:
+        batch.append(tweet)
+        if len(batch) == batch_size:
+            break
+    return batch
+
+
+def run(args, corpus, model, output_dir):
+    timer = StageTimer()
+    writer_args = SimpleNamespace(json_output=output_dir, tbl_output=output_dir, output_format=args.output_format,
+                                  checkpoint_every=args.checkpoint_every,
+                                  parquet_output=output_dir if args.parquet else '')
+    writer = AnnotationWriter(writer_args, 'benchmark.json.gz')
+    tweets_iterator = iter_json(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(corpus)), encoding='utf8'))
+    index = 0
+    while True:
+        batch = timer.time('decode', next_batch, tweets_iterator, args.batch_size)
+        if not batch:
+            break
+        timer.count('decode', len(batch))
+        indices = list(range(index, index + len(batch)))
+        index += len(batch)
+
+        selected = timer.time('filter', lambda: [(i, tweet) for i, tweet in zip(indices, batch)
+                                                 if tweet['lang_z'] == 1])
+        timer.count('filter', len(batch))
+        if not selected:
+            continue
+        texts = timer.time('normalize', lambda: [tweet_text(tweet) for _, tweet in selected])
+        timer.count('normalize', len(texts))
+
+        if model is None:
+            predictions = [0.0] * len(texts)
+        else:
+            # inference tokenizes again on its own, tokenize measures tokenization in isolation
+            if hasattr(model, 'tokenizer'):
+                timer.time('tokenize', token_lengths, model, [text.lower() for text in texts])
+                timer.count('tokenize', len(texts))
+            predictions = timer.time('inference', lambda: np.atleast_1d(predict(model, texts, args.bucket_size)))
+            timer.count('inference', len(texts))
+
+        timer.time('serialize', writer.write, [i for i, _ in selected], [tweet for _, tweet in selected], texts,
+                   [float(prediction) for prediction in predictions])
+        timer.count('serialize', len(texts))
+    timer.time('serialize', writer.close)
+    return timer.report()
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    for stage, stage_results in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        ratio = stage_results['tweets_per_s'] / baseline['stages'][stage]['tweets_per_s']
+        message = f'{stage}: {ratio:.2f}x throughput of baseline ({baseline.get("version")})'
+        if ratio < 1 - tolerance:
+            logging.warning(f'Regression - {message}')
+        else:
+            logging.info(message)
+
+
+def main(args):
+    # all tweets are sampled, so that lang_z filtering is measured on the real ratio
+    tweets = synthetic_tweets(args) if args.synthetic > 0 else sample_tweets(args.json_input, args.sample_size,
+                                                                             args.manual_seed, slovene_only=False)
+    corpus = gzip.compress(json.dumps(tweets).encode('utf8'))
+    logging.info(f'Benchmarking on {len(tweets)} {"synthetic" if args.synthetic > 0 else "sampled"} tweets '
+                 f'({len(corpus) / 1024 ** 2:.1f} MB compressed)')
+    del tweets
+    rss = {'corpus': peak_rss_mb()}
+
+    model = None if args.no_model else load_model(args)
+    if model is not None:
+        # warm up
+        predict(model, ['warm up'] * 32, args.bucket_size)
+    rss['model'] = peak_rss_mb()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        stages = run(args, corpus, model, output_dir)
+        duration = time.perf_counter() - start
+    rss['end'] = peak_rss_mb()
+
+    results = {
+        'version': git_version(),
+        'created': time.time(),
+        'corpus': 'synthetic' if args.synthetic > 0 else args.json_input,
+        'config': vars(args),
+        'stages': stages,
+        'end_to_end': {'tweets': stages['decode']['tweets'], 'seconds': duration,
+                       'tweets_per_s': stages['decode']['tweets'] / duration},
+        'peak_rss_mb': rss,
+    }
+    for stage, stage_results in stages.items():
+        logging.info(f'{stage}: {stage_results["tweets_per_s"]:.1f} tweets/s - batch latency p50 '
+                     f'{stage_results["batch_latency_ms"]["p50"]:.2f} ms, p99 '
+                     f'{stage_results["batch_latency_ms"]["p99"]:.2f} ms')
+    logging.info(f'End to end: {results["end_to_end"]["tweets_per_s"]:.1f} tweets/s - peak RSS {rss["end"]:.0f} MB')
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    logging.info(f'Results saved to {args.output}')
+    if args.baseline:
+        compare(results, args.baseline, args.tolerance)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure throughput of every stage of process_scraped_data on synthetic or sampled tweets.')
+    parser.add_argument('--json_input', default='data/json_data_input/',
+                        help='input folder with gz files')
+    parser.add_argument('--sample_size', type=int, default=20000,
+                        help='Number of tweets randomly sampled from json_input.')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='If > 0, benchmark on this many generated tweets instead of sampled ones.')
+    parser.add_argument('--slovene_ratio', type=float, default=0.5,
+                        help='Share of generated tweets with lang_z == 1.')
+    parser.add_argument('--batch_size', type=int, default=4096,
+                        help='Number of tweets per batch, latency percentiles are computed over batches.')
+    parser.add_argument('--bucket_size', type=int, default=0,
+                        help='If > 0, predict batches in length-sorted buckets of this size.')
+    parser.add_argument('--output_format', choices=['json', 'jsonl'], default='json',
+                        help='Serialization format of annotated tweets.')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Serialize annotated tweets to Parquet as well.')
+    parser.add_argument('--checkpoint_every', type=int, default=10000,
+                        help='Checkpoint interval of the serialization stage.')
+    parser.add_argument('--no_model', action='store_true',
+                        help='Skip tokenization and inference, to benchmark the rest of the pipeline alone.')
+    add_model_arguments(parser)
+    parser.add_argument('--output', default='data/benchmarks/pipeline.json',
+                        help='JSON file results are saved to.')
+    parser.add_argument('--baseline', default='',
+                        help='Results of an earlier run, throughput of every stage is compared with it.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative throughput drop against baseline reported as a regression.')
+    parser.add_argument('--manual_seed', type=int, default=23,
+                        help='manual seed')
+    args = parser.parse_args()
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))
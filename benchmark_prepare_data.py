@@ -0,0 +1,57 @@
+import argparse
+import logging
+import time
+
+from prepare_data import swap_diacritics, tbl_input_generator
+
+logging.basicConfig(level=logging.INFO)
+
+
+def legacy_tbl_input_generator(path):
+    # implementation prepare_data used before streaming, kept as reference
+    with open(path, 'r') as f:
+        wn = 0
+        dn = 0
+        for line in f.readlines():
+            if line == '\n':
+                yield dn / wn
+                wn = 0
+                dn = 0
+            else:
+                word, norm_word = line.strip().split('\t')
+                wn += 1
+                dn += 1 if swap_diacritics(word.lower()) != swap_diacritics(norm_word.lower()) else 0
+
+
+def run(name, generator, path, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        scores = list(generator(path))
+        best = min(best, time.time() - start)
+    logging.info(f'{name}: {best:.3f}s - {len(scores) / best:.1f} sentences/s')
+    return scores, best
+
+
+def main(args):
+    for path in args.tbl_input:
+        legacy_scores, legacy_duration = run('legacy', legacy_tbl_input_generator, path, args.repeats)
+        scores, duration = run('current', tbl_input_generator, path, args.repeats)
+        # scores have to be bit-identical, not only close
+        assert [score.hex() for score in scores] == [score.hex() for score in legacy_scores], \
+            f'Scores of {path} differ from legacy implementation'
+        logging.info(f'{path}: {len(scores)} identical scores, speedup {legacy_duration / duration:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare prepare_data score computation with the legacy implementation.')
+    parser.add_argument('tbl_input', nargs='+',
+                        help='.tbl files (from babushka-bench)')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of runs, the fastest one is reported.')
+    args = parser.parse_args()
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))
@@ -0,0 +1,71 @@
+import logging
+import math
+
+import joblib
+import numpy as np
+
+from postprocess_scraped_data import parse_bands
+from process_scraped_data import predict
+
+
+class CascadeModel(object):
+    """Scores texts with a cheap char n-gram model and escalates only some of them to the transformer.
+
+    A text is escalated when its cheap score lies inside one of the bands of interest or within margin of a band
+    boundary, all other texts keep the cheap score. Agreement of both models is tracked on escalated texts.
+    """
+    def __init__(self, model, cheap_model_path, vectorizer_path, bands, margin, bucket_size=0):
+        self.model = model
+        self.cheap_model = joblib.load(cheap_model_path)
+        self.vectorizer = joblib.load(vectorizer_path)
+        self.bands = parse_bands(bands)
+        self.margin = margin
+        self.bucket_size = bucket_size
+        self.scored_num = 0
+        self.escalated_num = 0
+        self.band_agreement_num = 0
+        self.absolute_error = 0.0
+        # running sums for pearson correlation of cheap and transformer scores
+        self.sums = np.zeros(5)
+
+    def band(self, score):
+        for name, low, high in self.bands:
+            if low < score < high:
+                return name
+        return None
+
+    def escalate(self, scores):
+        mask = np.zeros(len(scores), dtype=bool)
+        for _, low, high in self.bands:
+            mask |= (scores > low - self.margin) & (scores < high + self.margin)
+        return mask
+
+    def predict(self, to_predict):
+        texts = list(to_predict)
+        predictions = np.atleast_1d(self.cheap_model.predict(self.vectorizer.transform(texts))).astype(float)
+        mask = self.escalate(predictions)
+        if mask.any():
+            cheap = predictions[mask]
+            escalated = np.atleast_1d(predict(self.model, [text for text, m in zip(texts, mask) if m],
+                                              self.bucket_size))
+            predictions[mask] = escalated
+
+            self.band_agreement_num += sum(self.band(c) == self.band(e) for c, e in zip(cheap, escalated))
+            self.absolute_error += float(np.abs(cheap - escalated).sum())
+            self.sums += [cheap.sum(), escalated.sum(), (cheap ** 2).sum(), (escalated ** 2).sum(),
+                          (cheap * escalated).sum()]
+        self.scored_num += len(texts)
+        self.escalated_num += int(mask.sum())
+        return predictions, None
+
+    def report(self):
+        n = self.escalated_num
+        logging.info(f'Cascade: escalated {n} / {self.scored_num} tweets '
+                     f'({100 * n / self.scored_num if self.scored_num else 0:.2f}%)')
+        if n == 0:
+            return
+        sum_x, sum_y, sum_xx, sum_yy, sum_xy = self.sums
+        denominator = math.sqrt(max(n * sum_xx - sum_x ** 2, 0) * max(n * sum_yy - sum_y ** 2, 0))
+        pearson = (n * sum_xy - sum_x * sum_y) / denominator if denominator else float('nan')
+        logging.info(f'Cascade agreement on escalated tweets - same band: {100 * self.band_agreement_num / n:.2f}% | '
+                     f'mean absolute difference: {self.absolute_error / n:.4f} | Pearson: {pearson:.4f}')
@@ -0,0 +1,127 @@
+import argparse
+import logging
+import os
+import time
+from argparse import Namespace
+from shutil import copyfile
+
+import numpy as np
+
+from benchmark_bucketing import sample_texts
+from onnx_backend import evaluate
+from process_scraped_data import add_model_arguments, load_model, predict
+from regression_bert import add_training_arguments, read_data, train
+
+logging.basicConfig(level=logging.INFO)
+transformers_logger = logging.getLogger("transformers")
+transformers_logger.setLevel(logging.WARNING)
+
+POOL_NAME = 'pool.tbl'
+
+
+def label_pool(args, data_dir):
+    pool_path = os.path.join(data_dir, POOL_NAME)
+    if os.path.exists(pool_path):
+        logging.info(f'Using teacher labels from {pool_path}')
+        return
+    texts = sample_texts(args)
+    teacher = load_model(args)
+    logging.info(f'Labelling {len(texts)} tweets with teacher {args.bert_model}')
+    with open(pool_path + '.part', 'w') as f:
+        for start in range(0, len(texts), args.batch_size):
+            batch = texts[start:start + args.batch_size]
+            for text, prediction in zip(batch, np.atleast_1d(predict(teacher, batch, args.bucket_size))):
+                f.write(f'{text.lower()}\t{prediction}\n')
+    os.replace(pool_path + '.part', pool_path)
+
+
+def prepare_data(args, data_dir):
+    os.makedirs(data_dir, exist_ok=True)
+    # gold dev split selects the best student epoch, gold test split is only used for the final evaluation
+    for filename in os.listdir(args.input):
+        if filename.find('test') != -1 or filename.find('dev') != -1 or args.gold_train:
+            copyfile(os.path.join(args.input, filename), os.path.join(data_dir, filename))
+    label_pool(args, data_dir)
+
+
+def train_student(args, data_dir):
+    student_dir = os.path.join(args.best_model, args.name)
+    if os.path.exists(os.path.join(student_dir, 'test_results.txt')):
+        logging.info(f'Using trained student from {student_dir}')
+        return student_dir
+    student_args = Namespace(**vars(args))
+    # student starts from the first layers of the fine-tuned teacher unless another bert is given
+    student_args.bert = args.bert or args.bert_model
+    train(student_args, *read_data(data_dir, False))
+    return student_dir
+
+
+def report(args, student_dir):
+    _, _, test_df = read_data(args.input, False)
+    texts = test_df['text'].tolist()
+    labels = test_df['labels'].to_numpy()
+
+    student_args = Namespace(**vars(args))
+    student_args.bert_model = student_dir
+    student_args.backend = 'pytorch'
+    student_args.cascade_model = ''
+    models = [(f'teacher ({args.backend})', load_model(args)),
+              (f'student ({args.num_hidden_layers} layers)', load_model(student_args))]
+
+    results = []
+    for name, model in models:
+        # warm up
+        model.predict(texts[:32])
+        _, pearson, spearman, duration = evaluate(name, model, texts, labels)
+        results.append([name, pearson, spearman, len(texts) / duration])
+
+    teacher_throughput = results[0][3]
+    print('| model | Pearson Correlation | Spearman Correlation | tweets/s | speedup |')
+    print('| --- | --- | --- | --- | --- |')
+    for name, pearson, spearman, throughput in results:
+        print(f'| {name} | {pearson:.4f} | {spearman:.4f} | {throughput:.1f} | {throughput / teacher_throughput:.2f}x |')
+
+
+def main(args):
+    data_dir = os.path.join(args.distill_data, args.name)
+    prepare_data(args, data_dir)
+    student_dir = train_student(args, data_dir)
+    report(args, student_dir)
+
+
+if __name__ == '__main__':
+    # teacher and student share --bert_type, resolve keeps a single definition of it
+    parser = argparse.ArgumentParser(
+        description='Distill the best standardness model into a smaller student trained on teacher labelled '
+                    'scraped tweets.', conflict_handler='resolve')
+    parser.add_argument('input',
+                        help='Path to gold input files (as used by regression_bert), dev split selects the best '
+                             'student and test split is used for the report.')
+    parser.add_argument('--json_input', default='data/json_data_input/',
+                        help='input folder with gz files')
+    parser.add_argument('--sample_size', type=int, default=200000,
+                        help='Number of Slovene tweets randomly sampled from json_input and labelled by the teacher.')
+    parser.add_argument('--batch_size', type=int, default=4096,
+                        help='Number of tweets the teacher labels at once.')
+    parser.add_argument('--bucket_size', type=int, default=256,
+                        help='If > 0, teacher predicts length-sorted buckets of this size.')
+    parser.add_argument('--distill_data', default='data/distillation/',
+                        help='Folder with teacher labelled data, one subfolder per student name.')
+    parser.add_argument('--gold_train', action='store_true',
+                        help='Train student on gold train split in addition to teacher labels.')
+    parser.add_argument('--name', default='student',
+                        help='Name under which teacher labels and student model will be saved.')
+    parser.add_argument('--epochs', type=int, default=5,
+                        help='Epochs number.')
+    parser.add_argument('--learning_rate', type=float, default=4e-5,
+                        help='Learning rate.')
+    parser.add_argument('--manual_seed', type=int, default=23,
+                        help='Manual seed.')
+    add_model_arguments(parser)
+    add_training_arguments(parser)
+    parser.set_defaults(num_hidden_layers=4)
+    args = parser.parse_args()
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import joblib
+import numpy as np
+from scipy import sparse
+
+VECTORIZER_NAME = 'vectorizer.pkl'
+CSR_ARRAYS = ['data', 'indices', 'indptr']
+
+
+def features_key(frames, params):
+    """Hash of extraction parameters and texts and labels of all dataframes."""
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf8'))
+    for df in frames:
+        key.update(b'\0')
+        for text, label in zip(df['text'], df['labels']):
+            key.update(f'{text}\t{label}\n'.encode('utf8'))
+    return key.hexdigest()
+
+
+def save_csr(folder, name, matrix):
+    # plain .npy files, unlike save_npz, can be memory mapped
+    matrix = sparse.csr_matrix(matrix)
+    for array in CSR_ARRAYS:
+        np.save(os.path.join(folder, f'{name}.{array}.npy'), getattr(matrix, array))
+    np.save(os.path.join(folder, f'{name}.shape.npy'), np.array(matrix.shape))
+
+
+def load_csr(folder, name, mmap_mode='r'):
+    arrays = [np.load(os.path.join(folder, f'{name}.{array}.npy'), mmap_mode=mmap_mode) for array in CSR_ARRAYS]
+    shape = tuple(np.load(os.path.join(folder, f'{name}.shape.npy')))
+    return sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def store(folder, names, write):
+    # write to temporary folder first, so that interrupted extraction is never mistaken for a finished one,
+    # one per process, as parallel runs (regression_bert sweeps) may extract the same features
+    tmp_folder = f'{folder}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    write(tmp_folder)
+    with open(os.path.join(tmp_folder, 'features.json'), 'w') as f:
+        json.dump(sorted(names), f)
+    try:
+        os.replace(tmp_folder, folder)
+    except OSError:
+        # another process stored the same features first
+        if not os.path.exists(folder):
+            raise
+        shutil.rmtree(tmp_folder)
+
+
+def stored_names(folder):
+    with open(os.path.join(folder, 'features.json'), 'r') as f:
+        return json.load(f)
+
+
+def load_or_extract(root, key, extract):
+    """Return memory mapped feature matrices and vectorizer stored under key, extracting them first if missing.
+
+    extract is called without arguments and returns a dict of sparse matrices and the fitted vectorizer.
+    """
+    folder = os.path.join(root, key)
+    if os.path.exists(folder):
+        logging.info(f'Loading features from {folder}')
+    else:
+        logging.info(f'Extracting features to {folder}')
+        features, vectorizer = extract()
+
+        def write(tmp_folder):
+            for name, matrix in features.items():
+                save_csr(tmp_folder, name, matrix)
+            joblib.dump(vectorizer, os.path.join(tmp_folder, VECTORIZER_NAME))
+        store(folder, features.keys(), write)
+
+    return ({name: load_csr(folder, name) for name in stored_names(folder)},
+            joblib.load(os.path.join(folder, VECTORIZER_NAME)))
+
+
+def load_or_tokenize(root, key, tokenize, mmap_mode='c'):
+    """Return memory mapped dense arrays (token ids, attention masks, ...) stored under key, tokenizing first if
+    missing.
+
+    tokenize is called without arguments and returns a dict of numpy arrays. Arrays are mapped copy-on-write by
+    default, as torch expects writable arrays.
+    """
+    folder = os.path.join(root, key)
+    if not os.path.exists(folder):
+        logging.info(f'Tokenizing to {folder}')
+        arrays = tokenize()
+
+        def write(tmp_folder):
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_folder, f'{name}.npy'), array)
+        store(folder, arrays.keys(), write)
+
+    return {name: np.load(os.path.join(folder, f'{name}.npy'), mmap_mode=mmap_mode) for name in stored_names(folder)}
@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import re
+import zlib
+
+import numpy as np
+
+from prediction_cache import connect
+
+# 16 bands of 8 rows find pairs with estimated Jaccard similarity above about 0.7
+NUM_PERM = 128
+LSH_BANDS = 16
+SHINGLE_SIZE = 5
+MINHASH_SEED = 23
+# Mersenne prime, (a * x + b) of hashes below it fits into uint64
+_PRIME = (1 << 31) - 1
+_RE_URL = re.compile(r'https?://\S+')
+_RE_MENTION = re.compile(r'[@#]\w+')
+_RE_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    # retweets, mentions, hashtags and links do not make tweets different
+    text = text.lower()
+    if text.startswith('rt '):
+        text = text[3:]
+    text = _RE_MENTION.sub(' ', _RE_URL.sub(' ', text))
+    return _RE_NON_WORD.sub(' ', text).strip()
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class NearDuplicateIndex(object):
+    """Persistent MinHash/LSH index of tweets, finds tweets nearly identical to already indexed ones.
+
+    Signatures and LSH buckets are stored in SQLite, so every run also dedupes against tweets kept by earlier runs.
+    Tweets sharing an LSH bucket with a new tweet are candidates, which count as duplicates if their signatures
+    estimate Jaccard similarity of char shingles of at least threshold.
+    """
+    def __init__(self, path, threshold):
+        self.connection = connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS signatures (id TEXT PRIMARY KEY, signature BLOB NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS buckets (bucket INTEGER NOT NULL, id TEXT NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (bucket)')
+        params = f'{NUM_PERM}\t{LSH_BANDS}\t{SHINGLE_SIZE}\t{MINHASH_SEED}'
+        stored = self.connection.execute('SELECT value FROM meta WHERE key = ?', ('params',)).fetchone()
+        if stored is None:
+            self.connection.execute('INSERT INTO meta VALUES (?, ?)', ('params', params))
+        elif stored[0] != params:
+            raise ValueError(f'{path} was built with different MinHash parameters ({stored[0]})')
+        self.connection.commit()
+
+        rng = np.random.RandomState(MINHASH_SEED)
+        self.a = rng.randint(1, _PRIME, size=(NUM_PERM, 1)).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=(NUM_PERM, 1)).astype(np.uint64)
+        self.threshold = threshold
+
+    def signature(self, text):
+        hashes = np.array([zlib.crc32(shingle.encode('utf8')) % _PRIME for shingle in shingles(normalize(text))],
+                          dtype=np.uint64)
+        return ((self.a * hashes + self.b) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def buckets(self, signature):
+        rows = NUM_PERM // LSH_BANDS
+        # band number is hashed in, so that equal rows of different bands do not share a bucket
+        return [int.from_bytes(hashlib.blake2b(bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes(),
+                                               digest_size=8).digest(), 'big', signed=True)
+                for band in range(LSH_BANDS)]
+
+    def duplicate_of(self, signature, buckets):
+        candidates = [candidate for candidate, in self.connection.execute(
+            f'SELECT DISTINCT id FROM buckets WHERE bucket IN ({",".join("?" * len(buckets))})', buckets)]
+        for candidate in candidates:
+            candidate_signature = np.frombuffer(self.connection.execute(
+                'SELECT signature FROM signatures WHERE id = ?', (candidate,)).fetchone()[0], dtype=np.uint32)
+            if (candidate_signature == signature).mean() >= self.threshold:
+                return candidate
+        return None
+
+    def add(self, tweet_id, text):
+        """Index tweet unless it is a near-duplicate of an indexed one, return id of that one or None."""
+        # tweets kept by an earlier run are not duplicates of themselves
+        if self.connection.execute('SELECT 1 FROM signatures WHERE id = ?', (tweet_id,)).fetchone():
+            return None
+        signature = self.signature(text)
+        buckets = self.buckets(signature)
+        duplicate = self.duplicate_of(signature, buckets)
+        if duplicate is None:
+            self.connection.execute('INSERT INTO signatures VALUES (?, ?)', (tweet_id, signature.tobytes()))
+            self.connection.executemany('INSERT INTO buckets VALUES (?, ?)', [(bucket, tweet_id) for bucket in buckets])
+        return duplicate
+
+    def filter(self, items, limit):
+        """Keep at most limit (id, text) items that are not near-duplicates, return them and number of examined."""
+        kept = []
+        examined = 0
+        for tweet_id, text in items:
+            if len(kept) >= limit:
+                break
+            examined += 1
+            if self.add(tweet_id, text) is None:
+                kept.append((tweet_id, text))
+        self.connection.commit()
+        return kept, examined
+
+    def report(self):
+        size = self.connection.execute('SELECT COUNT(*) FROM signatures').fetchone()[0]
+        logging.info(f'Near-duplicate index: {size} tweets')
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
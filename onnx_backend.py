@@ -0,0 +1,160 @@
+import argparse
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from scipy import stats
+
+logging.basicConfig(level=logging.INFO)
+transformers_logger = logging.getLogger("transformers")
+transformers_logger.setLevel(logging.WARNING)
+
+ONNX_MODEL_NAME = 'model.onnx'
+QUANTIZED_ONNX_MODEL_NAME = 'model.quant.onnx'
+
+
+class LogitsOnly(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+
+class OnnxModel(object):
+    """Runs an exported regressor through onnxruntime on CPU.
+
+    Mirrors the parts of simpletransformers' ClassificationModel used for prediction (`predict`, `tokenizer` and
+    `args.max_seq_length` / `args.eval_batch_size`), so it can be used in its place.
+    """
+    def __init__(self, model_dir, quantized=False, threads=0, max_seq_length=128, eval_batch_size=32):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.args = SimpleNamespace(max_seq_length=max_seq_length, eval_batch_size=eval_batch_size)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_path = os.path.join(model_dir, QUANTIZED_ONNX_MODEL_NAME if quantized else ONNX_MODEL_NAME)
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+    def predict(self, to_predict):
+        to_predict = list(to_predict)
+        raw_outputs = []
+        for start in range(0, len(to_predict), self.args.eval_batch_size):
+            # pad only to the longest text in batch
+            encoded = self.tokenizer(to_predict[start:start + self.args.eval_batch_size], padding=True,
+                                     truncation=True, max_length=self.args.max_seq_length, return_tensors='np')
+            raw_outputs.append(self.session.run(None, {
+                'input_ids': encoded['input_ids'].astype(np.int64),
+                'attention_mask': encoded['attention_mask'].astype(np.int64),
+            })[0])
+        # onnxruntime returns float32, predictions are float64 as with simpletransformers, so they serialize to json
+        raw_outputs = np.concatenate(raw_outputs).astype(np.float64) if raw_outputs else np.empty((0, 1))
+        return np.squeeze(raw_outputs), raw_outputs
+
+
+def export(args):
+    from process_scraped_data import set_up_model
+
+    os.makedirs(args.onnx_model, exist_ok=True)
+    model = set_up_model(args)
+    module = LogitsOnly(model.model.cpu()).eval()
+    dummy = model.tokenizer(['dummy input'], return_tensors='pt')
+    onnx_path = os.path.join(args.onnx_model, ONNX_MODEL_NAME)
+    torch.onnx.export(
+        module,
+        (dummy['input_ids'], dummy['attention_mask']),
+        onnx_path,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['logits'],
+        dynamic_axes={
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            'logits': {0: 'batch'},
+        },
+        opset_version=14,
+    )
+    model.tokenizer.save_pretrained(args.onnx_model)
+    logging.info(f'Exported {args.bert_model} to {onnx_path}')
+
+    if args.quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantized_path = os.path.join(args.onnx_model, QUANTIZED_ONNX_MODEL_NAME)
+        quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+        logging.info(f'Saved int8 quantized model to {quantized_path}')
+
+
+def read_dev(input_path):
+    # same split as regression_bert
+    dev_data = []
+    for filename in sorted(os.listdir(input_path)):
+        if filename.find('dev') != -1:
+            with open(os.path.join(input_path, filename), 'r') as f:
+                dev_data += [[line.strip().split('\t')[0].lower(), float(line.strip().split('\t')[1])]
+                             for line in f.readlines()]
+    return [text for text, _ in dev_data], np.array([label for _, label in dev_data])
+
+
+def evaluate(name, model, texts, labels):
+    start = time.time()
+    predictions = np.atleast_1d(model.predict(texts)[0])
+    duration = time.time() - start
+    pearson = stats.pearsonr(predictions, labels)[0]
+    spearman = stats.spearmanr(predictions, labels)[0]
+    logging.info(f'{name} - Pearson: {pearson:.4f} | Spearman: {spearman:.4f} | '
+                 f'{len(texts) / duration:.1f} texts/s')
+    return predictions, pearson, spearman, duration
+
+
+def parity(args):
+    from process_scraped_data import set_up_model
+
+    texts, labels = read_dev(args.input)
+    torch_predictions, torch_pearson, torch_spearman, torch_duration = evaluate(
+        'pytorch', set_up_model(args), texts, labels)
+    onnx_predictions, onnx_pearson, onnx_spearman, onnx_duration = evaluate(
+        'onnx', OnnxModel(args.onnx_model, quantized=args.quantize), texts, labels)
+
+    logging.info(f'Drift - Pearson: {onnx_pearson - torch_pearson:+.4f} | '
+                 f'Spearman: {onnx_spearman - torch_spearman:+.4f}')
+    logging.info(f'onnx vs pytorch predictions - Pearson: {stats.pearsonr(onnx_predictions, torch_predictions)[0]:.4f} '
+                 f'| max absolute difference: {np.abs(onnx_predictions - torch_predictions).max():.4f}')
+    logging.info(f'Speedup: {torch_duration / onnx_duration:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export standardness regressor to ONNX and compare it with the PyTorch model.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export best model to ONNX.')
+    parity_parser = subparsers.add_parser('parity', help='Compare ONNX and PyTorch models on dev split.')
+    parity_parser.add_argument('input',
+                               help='Path to input files (as used by regression_bert).')
+    for subparser in [export_parser, parity_parser]:
+        subparser.add_argument('--bert_model', default='data/best_models/sloberta_10/',
+                               help='path to fine-tuned bert model')
+        subparser.add_argument('--bert_type', default='camembert',
+                               help='Type of bert used.')
+        subparser.add_argument('--onnx_model', default='data/onnx_models/sloberta_10/',
+                               help='Folder with exported ONNX model and tokenizer.')
+        subparser.add_argument('--quantize', action='store_true',
+                               help='Export / use dynamically int8 quantized model.')
+        subparser.add_argument('--manual_seed', type=int, default=23,
+                               help='manual seed')
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == 'export':
+        export(args)
+    else:
+        parity(args)
+    logging.info("TIME: {}".format(time.time() - start))
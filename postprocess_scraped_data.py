@@ -1,9 +1,11 @@
+import functools
 import gzip
-import random
+import hashlib
+import heapq
+import multiprocessing
 
 from simpletransformers.classification import ClassificationModel, ClassificationArgs
 import argparse
-import json
 import os
 import re
 import shutil
@@ -13,12 +15,30 @@ import numpy as np
 
 import logging
 
+from near_duplicates import NearDuplicateIndex
+from process_scraped_data import iter_json
+
 _RE_COMBINE_WHITESPACE = re.compile(r"\s+")
 logging.basicConfig(level=logging.INFO)
 transformers_logger = logging.getLogger("transformers")
 transformers_logger.setLevel(logging.WARNING)
 
 
+DEFAULT_BANDS = '0.2-0.3,0.3-0.4,0.4-0.5,0.5+'
+
+
+def parse_bands(bands):
+    """Parse comma separated standardness bands like '0.2-0.3,0.5+' into (name, low, high) tuples."""
+    parsed = []
+    for name in bands.split(','):
+        if name.endswith('+'):
+            low, high = float(name[:-1]), float('inf')
+        else:
+            low, high = (float(bound) for bound in name.split('-'))
+        parsed.append((name, low, high))
+    return parsed
+
+
 def validate(tweet_text):
     tweet_list = tweet_text.split()
     discard_words_num = 0
@@ -31,26 +51,84 @@ def validate(tweet_text):
     return True
 
 
-def process(args, file, raw_input):
-    logging.info(f'Processing {file}')
-    with gzip.open(os.path.join(args.json_output, file), 'r') as json_in_f:
-        json_data = json.load(json_in_f)
-        for i, tweet in enumerate(json_data):
+class BandReservoir(object):
+    """Uniform sample of at most size distinct tweets of a band, kept in constant memory.
+
+    Every tweet gets a priority from a seeded hash of its id and the reservoir keeps the size tweets with the lowest
+    priorities. The sample does not depend on the order tweets come in, so a tweet seen twice is kept once and
+    reservoirs filled from different files can be merged into the sample of all of them.
+    """
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        # max-heap of (-priority, id_str, text)
+        self.heap = []
+        self.ids = set()
+
+    def priority(self, tweet_id):
+        return int.from_bytes(hashlib.blake2b(f'{self.seed}\t{tweet_id}'.encode('utf8'), digest_size=8).digest(),
+                              'big')
+
+    def add(self, tweet_id, text, priority=None):
+        if tweet_id in self.ids:
+            return
+        if priority is None:
+            priority = self.priority(tweet_id)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, (-priority, tweet_id, text))
+        elif priority < -self.heap[0][0]:
+            self.ids.discard(heapq.heapreplace(self.heap, (-priority, tweet_id, text))[1])
+        else:
+            return
+        self.ids.add(tweet_id)
+
+    def merge(self, other):
+        for negative_priority, tweet_id, text in other.heap:
+            self.add(tweet_id, text, -negative_priority)
+
+    def items(self):
+        return [(tweet_id, text) for _, tweet_id, text in sorted(self.heap, reverse=True)]
+
+
+def reservoir_size(args):
+    # near-duplicates are dropped from samples afterwards, so more tweets are sampled than needed
+    return args.batch_sample_size * (args.dedup_oversample if args.dedup_index else 1)
+
+
+def read_json(args, file, bands):
+    with gzip.open(os.path.join(args.json_output, file), 'rt', encoding='utf8') as json_in_f:
+        # handles both json and jsonl outputs of process_scraped_data
+        for tweet in iter_json(json_in_f):
             twe = tweet['full_text'] if 'full_text' in tweet else tweet['text']
-            tweet_text = _RE_COMBINE_WHITESPACE.sub(" ", twe).strip()
-            if validate(tweet_text):
-                if 0.2 < tweet['standardness'] < 0.3:
-                    if tweet['id_str'] not in raw_input['0.2-0.3']:
-                        raw_input['0.2-0.3'][tweet['id_str']] = tweet_text
-                if 0.3 < tweet['standardness'] < 0.4:
-                    if tweet['id_str'] not in raw_input['0.3-0.4']:
-                        raw_input['0.3-0.4'][tweet['id_str']] = tweet_text
-                if 0.4 < tweet['standardness'] < 0.5:
-                    if tweet['id_str'] not in raw_input['0.4-0.5']:
-                        raw_input['0.4-0.5'][tweet['id_str']] = tweet_text
-                if 0.5 < tweet['standardness']:
-                    if tweet['id_str'] not in raw_input['0.5+']:
-                        raw_input['0.5+'][tweet['id_str']] = tweet_text
+            yield tweet['id_str'], _RE_COMBINE_WHITESPACE.sub(" ", twe).strip(), tweet['standardness']
+
+
+def read_parquet(args, file, bands):
+    import pyarrow.dataset as ds
+
+    # only tweets inside some band are read, row groups outside of all bands are skipped using their statistics
+    condition = None
+    for _, low, high in bands:
+        band_condition = ds.field('standardness') > low
+        if high != float('inf'):
+            band_condition = band_condition & (ds.field('standardness') < high)
+        condition = band_condition if condition is None else condition | band_condition
+    dataset = ds.dataset(os.path.join(args.parquet_input, file), format='parquet')
+    for batch in dataset.to_batches(columns=['id', 'text', 'standardness'], filter=condition):
+        yield from zip(*[batch.column(name).to_pylist() for name in ['id', 'text', 'standardness']])
+
+
+def process(args, file):
+    logging.info(f'Processing {file}')
+    bands = parse_bands(args.bands)
+    reservoirs = {name: BandReservoir(reservoir_size(args), args.manual_seed) for name, _, _ in bands}
+    read = read_parquet if args.parquet_input else read_json
+    for tweet_id, tweet_text, standardness in read(args, file, bands):
+        if validate(tweet_text):
+            for name, low, high in bands:
+                if low < standardness < high:
+                    reservoirs[name].add(tweet_id, tweet_text)
+    return reservoirs
 
 
 def save_output(args, raw_input, f_name):
@@ -60,33 +138,44 @@ def save_output(args, raw_input, f_name):
             tbl_out_f.write(f'{tid}\t{text}\n')
 
 
-def sample_list(list, args):
-    if args.batch_sample_size > len(list):
-        return list
-
-    return random.sample(list, args.batch_sample_size)
-
-
 def main(args):
-    random.seed(args.manual_seed)
     if args.overwrite:
         shutil.rmtree(args.tbl_batch_output)
     os.makedirs(os.path.dirname(args.tbl_batch_output), exist_ok=True)
 
-    raw_input = {}
-    raw_input['0.2-0.3'] = {}
-    raw_input['0.3-0.4'] = {}
-    raw_input['0.4-0.5'] = {}
-    raw_input['0.5+'] = {}
-
-    # populate raw_input
-    for file in sorted(os.listdir(args.json_output)):
-        process(args, file, raw_input)
-
-    save_output(args, sample_list([[k, v] for k, v in raw_input['0.2-0.3'].items()], args), '0.2-0.3')
-    save_output(args, sample_list([[k, v] for k, v in raw_input['0.3-0.4'].items()], args), '0.3-0.4')
-    save_output(args, sample_list([[k, v] for k, v in raw_input['0.4-0.5'].items()], args), '0.4-0.5')
-    save_output(args, sample_list([[k, v] for k, v in raw_input['0.5+'].items()], args), '0.5+')
+    # skip outputs of unfinished process_scraped_data runs
+    if args.parquet_input:
+        files = [file for file in sorted(os.listdir(args.parquet_input)) if file.endswith('.parquet')]
+    else:
+        files = [file for file in sorted(os.listdir(args.json_output)) if not file.endswith('.part')]
+    reservoirs = {name: BandReservoir(reservoir_size(args), args.manual_seed) for name, _, _ in
+                  parse_bands(args.bands)}
+
+    def merge(file_reservoirs):
+        for name, reservoir in file_reservoirs.items():
+            reservoirs[name].merge(reservoir)
+
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            for file_reservoirs in pool.imap_unordered(functools.partial(process, args), files):
+                merge(file_reservoirs)
+    else:
+        for file in files:
+            merge(process(args, file))
+
+    index = NearDuplicateIndex(args.dedup_index, args.dedup_threshold) if args.dedup_index else None
+    for name, reservoir in reservoirs.items():
+        items = reservoir.items()
+        if index is not None:
+            # in sample order, so that the kept tweets are still a uniform sample
+            items, examined = index.filter(items, args.batch_sample_size)
+            logging.info(f'Band {name}: {examined - len(items)} of {examined} examined tweets are near-duplicates '
+                         f'({100 * (examined - len(items)) / examined if examined else 0:.2f}% dedup rate)')
+        logging.info(f'Band {name}: {len(items)} tweets sampled')
+        save_output(args, items, name)
+    if index is not None:
+        index.report()
+        index.close()
 
 
 if __name__ == '__main__':
@@ -94,6 +183,9 @@ if __name__ == '__main__':
         description='Annotate standardness to data scraped from twitter.')
     parser.add_argument('--json_output', default='data/json_data_output/',
                         help='output folder with gz files')
+    parser.add_argument('--parquet_input', default='',
+                        help='If set, read annotated tweets from Parquet files (parquet_output of '
+                             'process_scraped_data) in this folder instead of json_output.')
     parser.add_argument('--tbl_batch_output', default='data/tbl_batch_output/',
                         help='output folder with gz files')
     parser.add_argument('--overwrite', action='store_true',
@@ -102,6 +194,19 @@ if __name__ == '__main__':
                         help='manual seed')
     parser.add_argument('--batch_sample_size', type=int, default=20000,
                         help='Randomly obtain sample_size number of examples from tbl_output.')
+    parser.add_argument('--bands', default=DEFAULT_BANDS,
+                        help='Comma separated standardness bands, each sampled into its own file. A band low-high '
+                             'holds tweets with low < standardness < high, low+ those with standardness > low.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes input files are sampled in, their samples are merged.')
+    parser.add_argument('--dedup_index', default='',
+                        help='Path to SQLite MinHash/LSH index. If set, sampled tweets nearly identical to an earlier '
+                             'sampled tweet (of this or previous runs) are dropped and kept ones are added to it.')
+    parser.add_argument('--dedup_threshold', type=float, default=0.7,
+                        help='Estimated Jaccard similarity of char 5-grams above which tweets are near-duplicates.')
+    parser.add_argument('--dedup_oversample', type=int, default=2,
+                        help='With dedup_index, bands are sampled this many times batch_sample_size tweets, so that '
+                             'enough remain after near-duplicates are dropped.')
     args = parser.parse_args()
 
     start = time.time()
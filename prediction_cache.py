@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+# files that determine predictions of a model folder (weights, config and tokenizer)
+FINGERPRINT_FILES = ['config.json', 'pytorch_model.bin', 'model.safetensors', 'sentencepiece.bpe.model',
+                     'tokenizer.json', 'vocab.txt', 'vocab.json', 'merges.txt']
+# sqlite limits number of variables in a single query
+QUERY_CHUNK_SIZE = 500
+
+
+def connect(path):
+    """SQLite connection that can be shared between processes writing to the same file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, timeout=600)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+def select_by_keys(connection, table, columns, keys):
+    """Yield (key, columns...) rows of table with key in keys, in queries of at most QUERY_CHUNK_SIZE keys."""
+    keys = list(set(keys))
+    for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+        chunk = keys[start:start + QUERY_CHUNK_SIZE]
+        yield from connection.execute(
+            f'SELECT key, {columns} FROM {table} WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+
+
+def file_hash(fingerprint, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            fingerprint.update(block)
+
+
+def model_fingerprint(args):
+    if not args.cascade_model:
+        return backend_fingerprint(args)
+    # cascaded predictions also depend on the cheap model and on which tweets get escalated
+    fingerprint = hashlib.sha1(f'{backend_fingerprint(args)}\t{args.cascade_bands}\t{args.cascade_margin}'
+                               .encode('utf8'))
+    file_hash(fingerprint, args.cascade_model)
+    file_hash(fingerprint, args.cascade_vectorizer)
+    return fingerprint.hexdigest()
+
+
+def backend_fingerprint(args):
+    if args.backend == 'remote':
+        from scoring_server import RemoteModel
+
+        return RemoteModel(args.server_url).fingerprint()
+    if args.backend == 'onnx':
+        from onnx_backend import ONNX_MODEL_NAME, QUANTIZED_ONNX_MODEL_NAME
+
+        model_dir = args.onnx_model
+        files = FINGERPRINT_FILES + [QUANTIZED_ONNX_MODEL_NAME if args.quantize else ONNX_MODEL_NAME]
+    else:
+        model_dir = args.bert_model
+        files = FINGERPRINT_FILES
+
+    fingerprint = hashlib.sha1(f'{args.backend}\t{args.bert_type}'.encode('utf8'))
+    for file in files:
+        path = os.path.join(model_dir, file)
+        if os.path.exists(path):
+            fingerprint.update(file.encode('utf8'))
+            file_hash(fingerprint, path)
+    return fingerprint.hexdigest()
+
+
+class PredictionCache(object):
+    """Persistent store of predictions keyed by a hash of model fingerprint and normalized text.
+
+    Stored in SQLite, so it can be shared between workers and runs. Once it holds more than max_entries
+    predictions, the least recently used ones are evicted. Number of entries is kept up to date by triggers, so that
+    all workers sharing the file see inserts of the others.
+    """
+    def __init__(self, path, fingerprint, max_entries):
+        self.connection = connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                '(key BLOB PRIMARY KEY, prediction REAL NOT NULL, used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)')
+        self.connection.commit()
+        # exclusive, so that only one of the workers starting at once counts entries of an older cache file
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (num INTEGER NOT NULL)')
+        if self.connection.execute('SELECT num FROM entries').fetchone() is None:
+            self.connection.execute('INSERT INTO entries SELECT COUNT(*) FROM predictions')
+        self.connection.execute('CREATE TRIGGER IF NOT EXISTS predictions_insert AFTER INSERT ON predictions '
+                                'BEGIN UPDATE entries SET num = num + 1; END')
+        self.connection.execute('CREATE TRIGGER IF NOT EXISTS predictions_delete AFTER DELETE ON predictions '
+                                'BEGIN UPDATE entries SET num = num - 1; END')
+        self.connection.commit()
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha1(f'{self.fingerprint}\n{text.lower()}'.encode('utf8')).digest()
+
+    def get_many(self, keys):
+        found = dict(select_by_keys(self.connection, 'predictions', 'prediction', keys))
+        now = time.time()
+        self.connection.executemany('UPDATE predictions SET used = ? WHERE key = ?', [(now, key) for key in found])
+        # commit right away, an open write transaction would lock out other workers while this one predicts
+        self.connection.commit()
+        return found
+
+    def size(self):
+        return self.connection.execute('SELECT num FROM entries').fetchone()[0]
+
+    def put_many(self, items):
+        now = time.time()
+        self.connection.executemany('INSERT OR IGNORE INTO predictions VALUES (?, ?, ?)',
+                                    [(key, float(prediction), now) for key, prediction in items])
+        self.connection.commit()
+        if self.size() > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        # size is read again, another worker may have evicted in the meantime
+        size = self.size()
+        if size > self.max_entries:
+            # evict a bit more than necessary, so that eviction does not run on every batch
+            evict_num = size - int(self.max_entries * 0.9)
+            self.connection.execute('DELETE FROM predictions WHERE key IN '
+                                    '(SELECT key FROM predictions ORDER BY used LIMIT ?)', (evict_num,))
+            logging.info(f'Evicted {evict_num} cached predictions')
+        self.connection.commit()
+
+    def report(self):
+        total = self.hits + self.misses
+        logging.info(f'Prediction cache: {self.hits} hits / {total} tweets '
+                     f'({100 * self.hits / total if total else 0:.2f}% hit rate), {self.size()} entries stored')
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
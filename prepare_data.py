@@ -4,7 +4,7 @@ import time
 
 def raw_input_generator(path):
     with open(path, 'r') as f:
-        for line in f.readlines():
+        for line in f:
             yield line.strip()
 
 
@@ -12,26 +12,35 @@ def swap_diacritics(word):
     return word.replace('č', 'c').replace('ć', 'c').replace('š', 's').replace('ž', 'z')
 
 
-def tbl_input_generator(path):
+def tbl_input_generator(path, block_size=1 << 20):
     with open(path, 'r') as f:
         # word number
         wn = 0
         # diff number
         dn = 0
-        for line in f.readlines():
-            if line == '\n':
-                yield dn / wn
-                wn = 0
-                dn = 0
-            else:
-                word, norm_word = line.strip().split('\t')
-                wn += 1
-                dn += 1 if swap_diacritics(word.lower()) != swap_diacritics(norm_word.lower()) else 0
+        while True:
+            # complete lines with roughly block_size characters
+            lines = f.readlines(block_size)
+            if not lines:
+                break
+            block = ''.join(lines)
+            if block[-1] == '\n':
+                block = block[:-1]
+            # lowercase and swap diacritics of the whole block at once instead of word by word
+            for line in swap_diacritics(block.lower()).split('\n'):
+                if line == '':
+                    yield dn / wn
+                    wn = 0
+                    dn = 0
+                else:
+                    word, norm_word = line.strip().split('\t')
+                    wn += 1
+                    dn += word != norm_word
 
 
 def write(raw_generator, tbl_generator, path):
     with open(path, 'w') as f:
-        for rw, tb in zip(list(raw_generator), list(tbl_generator)):
+        for rw, tb in zip(raw_generator, tbl_generator):
             f.write(f'{rw}\t{tb}\n')
 
 
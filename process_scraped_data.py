@@ -1,69 +1,412 @@
 import gzip
+import itertools
 import random
 
 from simpletransformers.classification import ClassificationModel, ClassificationArgs
 import argparse
 import json
+import multiprocessing
 import os
 import re
 import shutil
 import time
 import pandas as pd
 import numpy as np
+import torch
 
 import logging
 
+from prediction_cache import PredictionCache, model_fingerprint
+
 _RE_COMBINE_WHITESPACE = re.compile(r"\s+")
+_JSON_SEPARATORS = frozenset(' \t\r\n,[]')
+_worker_model = None
 logging.basicConfig(level=logging.INFO)
 transformers_logger = logging.getLogger("transformers")
 transformers_logger.setLevel(logging.WARNING)
 
 
-def process(args, file, model):
-    if os.path.exists(os.path.join(args.tbl_output, file[:-3] + '.tbl')):
-        logging.info(f'Skipping {file} - already processed')
-        return
-    logging.info(f'Processing {file}')
-    raw_input = []
-    with gzip.open(os.path.join(args.json_input, file), 'r') as json_in_f:
-        json_data = json.load(json_in_f)
-        correct_tweets_indices = []
-        for i, tweet in enumerate(json_data):
-            if tweet['lang_z'] == 1:
-                correct_tweets_indices.append(i)
-                twe = tweet['full_text'] if 'full_text' in tweet else tweet['text']
-                text = _RE_COMBINE_WHITESPACE.sub(" ", twe).strip()
-                raw_input.append([text])
-    if len(raw_input) == 0:
-        logging.info(f'Skipping {file} - 0 hits')
-        return
-    with gzip.open(os.path.join(args.json_output, file), 'wt', encoding='utf8') as json_out_f, open(
-            os.path.join(args.tbl_output, file[:-3] + '.tbl'), 'w') as tbl_out_f:
+def cut_by_buffer_end(error, buffer):
+    # decoding a value cut in half fails inside a string running past the end of the buffer, or at most a few
+    # characters before the end (in a literal such as "tru" or in a \uXXXX escape)
+    return error.msg.startswith('Unterminated string') or len(buffer) - error.pos <= 6
+
+
+def iter_json(f, read_size=1 << 20, max_value_size=64 << 20):
+    """Yield top-level JSON values from a text stream one at a time.
+
+    Works on a JSON array (items are yielded without loading the whole array) as well as on JSON lines. Malformed
+    values raise JSONDecodeError instead of buffering the rest of the stream.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    while True:
+        # skip whitespace and array punctuation between values
+        while pos < len(buffer) and buffer[pos] in _JSON_SEPARATORS:
+            pos += 1
+        if pos == len(buffer):
+            buffer = f.read(read_size)
+            pos = 0
+            if not buffer:
+                return
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if not cut_by_buffer_end(e, buffer) or len(buffer) - pos > max_value_size:
+                raise
+            chunk = f.read(read_size)
+            if not chunk:
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield value
+        pos = end
+
+
+def read_tweets(args, file):
+    with gzip.open(os.path.join(args.json_input, file), 'rt', encoding='utf8') as json_in_f:
+        if args.stream:
+            yield from iter_json(json_in_f)
+        else:
+            yield from json.load(json_in_f)
+
+
+def tweet_text(tweet):
+    twe = tweet['full_text'] if 'full_text' in tweet else tweet['text']
+    return _RE_COMBINE_WHITESPACE.sub(" ", twe).strip()
+
+
+class ParquetAnnotations(object):
+    """Annotated tweets of one input file as a Parquet table with id, text, standardness and source columns.
+
+    Parquet files can not be appended to or truncated, so rows are buffered and written as a numbered chunk file on
+    every checkpoint. Closing merges the chunks, one row group each, into the final file.
+    """
+    def __init__(self, path, source):
+        import pyarrow
+
+        self.path = path
+        self.source = source
+        self.schema = pyarrow.schema([('id', pyarrow.string()), ('text', pyarrow.string()),
+                                      ('standardness', pyarrow.float64()),
+                                      ('source', pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))])
+        self.chunks = 0
+        self.ids = []
+        self.texts = []
+        self.predictions = []
+
+    def chunk_path(self, chunk):
+        return f'{self.path}.part-{chunk:05d}'
+
+    def remove_chunks(self, start=0):
+        chunk = start
+        while os.path.exists(self.chunk_path(chunk)):
+            os.remove(self.chunk_path(chunk))
+            chunk += 1
+
+    def resume(self, chunks):
+        # chunks written after the checkpoint and the merged file are written again
+        self.remove_chunks(chunks)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.chunks = chunks
+
+    def add(self, ids, texts, predictions):
+        self.ids += ids
+        self.texts += texts
+        self.predictions += predictions
+
+    def write_chunk(self):
+        import pyarrow
+        import pyarrow.parquet as pq
+
+        if not self.ids:
+            return
+        table = pyarrow.table([self.ids, self.texts, self.predictions,
+                               pyarrow.array([self.source] * len(self.ids)).dictionary_encode()], schema=self.schema)
+        tmp_path = self.chunk_path(self.chunks) + '.tmp'
+        pq.write_table(table, tmp_path, compression='zstd')
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.chunk_path(self.chunks))
+        self.chunks += 1
+        self.ids, self.texts, self.predictions = [], [], []
+
+    def merge(self):
+        import pyarrow.parquet as pq
+
+        self.write_chunk()
+        with pq.ParquetWriter(self.path + '.tmp', self.schema, compression='zstd') as writer:
+            for chunk in range(self.chunks):
+                writer.write_table(pq.read_table(self.chunk_path(chunk)))
+        os.replace(self.path + '.tmp', self.path)
+
+
+class AnnotationWriter(object):
+    """Incrementally writes annotated tweets of one input file to json_output and tbl_output.
+
+    Output goes to .part files that are renamed once the whole input file is processed, so an existing .tbl always
+    means a complete file. Files are only created once the first tweet is written, so inputs with 0 hits leave no
+    output behind. Every checkpoint_every tweets the output is synced to disk and its size stored in a .checkpoint
+    file, from which an interrupted run resumes. Each checkpointed chunk of json output is a separate gzip member,
+    so truncating to a checkpoint leaves a valid gzip file. With parquet_output, annotated tweets are also written
+    to a Parquet table.
+    """
+    def __init__(self, args, file):
+        self.file = file
+        self.json_path = os.path.join(args.json_output, file)
+        self.tbl_path = os.path.join(args.tbl_output, file[:-3] + '.tbl')
+        self.json_part_path = self.json_path + '.part'
+        self.tbl_part_path = self.tbl_path + '.part'
+        self.checkpoint_path = self.tbl_path + '.checkpoint'
+        self.output_format = args.output_format
+        self.checkpoint_every = args.checkpoint_every
+        self.parquet = None
+        if args.parquet_output:
+            self.parquet = ParquetAnnotations(os.path.join(args.parquet_output, file[:-3] + '.parquet'), file)
+        self.json_out_f = None
+        self.json_member = None
+        self.tbl_out_f = None
+        self.written = 0
+        self.checkpointed = 0
+        # index of the first input tweet without written output
+        self.next_index = 0
+        self.resume()
+
+    def resume(self):
+        if not os.path.exists(self.checkpoint_path):
+            # leftovers of a run interrupted before its first checkpoint
+            for path in [self.json_part_path, self.tbl_part_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            if self.parquet is not None:
+                self.parquet.resume(0)
+            return
+
+        with open(self.checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        if not os.path.exists(self.json_part_path) and os.path.exists(self.json_path):
+            # interrupted between renaming json and tbl output
+            os.replace(self.json_path, self.json_part_path)
+        os.truncate(self.json_part_path, checkpoint['json_size'])
+        os.truncate(self.tbl_part_path, checkpoint['tbl_size'])
+        self.written = self.checkpointed = checkpoint['written']
+        self.next_index = checkpoint['next_index']
+        if self.parquet is not None:
+            if 'parquet_chunks' not in checkpoint:
+                logging.warning(f'{self.file} was started without parquet_output, its Parquet table will miss the '
+                                f'first {self.written} tweets')
+            self.parquet.resume(checkpoint.get('parquet_chunks', 0))
+        self.open()
+        logging.info(f'Resuming {self.file} from tweet {self.next_index} ({self.written} already written)')
+
+    def open(self):
+        self.json_out_f = open(self.json_part_path, 'ab')
+        self.tbl_out_f = open(self.tbl_part_path, 'a')
+
+    def write_json(self, text):
+        if self.json_member is None:
+            self.json_member = gzip.GzipFile(filename='', mode='wb', fileobj=self.json_out_f)
+        self.json_member.write(text.encode('utf8'))
+
+    def write(self, indices, tweets, texts, predictions):
+        if self.json_out_f is None:
+            self.open()
+            if self.output_format == 'json':
+                self.write_json('[\n')
+
+        if self.parquet is not None:
+            self.parquet.add([tweet['id_str'] for tweet in tweets], list(texts), [float(prediction) for prediction in predictions])
+        for tweet, text, prediction in zip(tweets, texts, predictions):
+            # Save info to predictions.tbl
+            self.tbl_out_f.write(f'{text}\t{prediction}\n')
+
+            del tweet['lang_z']
+            tweet['standardness'] = prediction
+            if self.output_format == 'json':
+                if self.written > 0:
+                    self.write_json(',\n')
+                self.write_json(json.dumps(tweet, indent=1))
+            else:
+                self.write_json(json.dumps(tweet) + '\n')
+            self.written += 1
+
+        self.next_index = indices[-1] + 1
+        if self.written - self.checkpointed >= self.checkpoint_every:
+            self.checkpoint()
+
+    def sync(self):
+        if self.json_member is not None:
+            # only ends the gzip member, underlying file stays open
+            self.json_member.close()
+            self.json_member = None
+        for f in [self.json_out_f, self.tbl_out_f]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def checkpoint(self):
+        self.sync()
+        checkpoint = {
+            'next_index': self.next_index,
+            'written': self.written,
+            'json_size': os.fstat(self.json_out_f.fileno()).st_size,
+            'tbl_size': os.fstat(self.tbl_out_f.fileno()).st_size,
+        }
+        if self.parquet is not None:
+            self.parquet.write_chunk()
+            checkpoint['parquet_chunks'] = self.parquet.chunks
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        self.checkpointed = self.written
+
+    def close(self):
+        if self.json_out_f is None:
+            return
+        if self.output_format == 'json':
+            self.write_json('\n]')
+        self.sync()
+        self.json_out_f.close()
+        self.tbl_out_f.close()
+        if self.parquet is not None:
+            self.parquet.merge()
+        # tbl is renamed last, as it marks the file as processed
+        os.replace(self.json_part_path, self.json_path)
+        os.replace(self.tbl_part_path, self.tbl_path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        if self.parquet is not None:
+            # only removed now, as a resumed run needs them until tbl is in place
+            self.parquet.remove_chunks()
+
+
+class BatchScheduler(object):
+    """Collects Slovene tweets from any number of input files into fixed-size prediction batches.
 
-        predictions = predict(model, raw_input)
-        predictions = np.atleast_1d(predictions)
+    Predictions are routed back to the writer of the file each tweet came from and a file's outputs are
+    closed as soon as the file is fully read and all of its tweets are scored.
+    """
+    def __init__(self, args, model):
+        self.model = model
+        self.batch_size = args.batch_size
+        self.bucket_size = args.bucket_size
+        self.cache = None
+        if args.cache:
+            self.cache = PredictionCache(args.cache, model_fingerprint(args), args.cache_size)
+        self.writers = []
+        self.indices = []
+        self.tweets = []
+        self.pending = {}
+        self.finished = set()
+        self.batches_num = 0
+        self.tweets_num = 0
+        self.start = time.time()
 
-        # Save info to predictions.tbl
-        for text, program_pred in zip(raw_input, predictions):
-            tbl_out_f.write(f'{text[0]}\t{program_pred}\n')
+    def add(self, writer, index, tweet):
+        self.writers.append(writer)
+        self.indices.append(index)
+        self.tweets.append(tweet)
+        self.pending[writer] = self.pending.get(writer, 0) + 1
+        if len(self.tweets) >= self.batch_size:
+            self.flush()
 
-        final_json_data = []
-        for i, prediction in zip(correct_tweets_indices, predictions):
-            del json_data[i]['lang_z']
-            json_data[i]['standardness'] = prediction
-            final_json_data.append(json_data[i])
+    def finish(self, writer):
+        """Mark that all tweets of writer's input file were added."""
+        self.finished.add(writer)
+        if self.pending.get(writer, 0) == 0:
+            self.close_writer(writer)
 
-        json.dump(final_json_data, json_out_f, indent=1)
+    def predict(self, texts):
+        if self.cache is None:
+            return np.atleast_1d(predict(self.model, texts, self.bucket_size))
 
+        keys = [self.cache.key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        # repeated texts inside a batch are scored only once as well
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            missing_predictions = np.atleast_1d(predict(self.model, list(missing.values()), self.bucket_size))
+            self.cache.put_many(zip(missing.keys(), missing_predictions))
+            cached.update(zip(missing.keys(), missing_predictions))
+        self.cache.hits += len(texts) - len(missing)
+        self.cache.misses += len(missing)
+        return np.array([cached[key] for key in keys])
 
-def set_up_model(args):
+    def flush(self):
+        if len(self.tweets) == 0:
+            return
+        texts = [tweet_text(tweet) for tweet in self.tweets]
+        predictions = self.predict(texts)
+
+        # write consecutive tweets of the same file at once
+        start = 0
+        for writer, group in itertools.groupby(self.writers):
+            end = start + len(list(group))
+            writer.write(self.indices[start:end], self.tweets[start:end], texts[start:end], predictions[start:end])
+            self.pending[writer] -= end - start
+            start = end
+
+        self.batches_num += 1
+        self.tweets_num += len(self.tweets)
+        logging.info(f'Batch {self.batches_num}: {len(self.tweets)} tweets - '
+                     f'{self.tweets_num / (time.time() - self.start):.1f} tweets/s overall')
+
+        for writer in set(self.writers):
+            if writer in self.finished and self.pending[writer] == 0:
+                self.close_writer(writer)
+        self.writers = []
+        self.indices = []
+        self.tweets = []
+
+    def close(self):
+        """Score remaining tweets and close the prediction cache."""
+        self.flush()
+        if hasattr(self.model, 'report'):
+            self.model.report()
+        if self.cache is not None:
+            self.cache.report()
+            self.cache.close()
+
+    def close_writer(self, writer):
+        writer.close()
+        self.finished.remove(writer)
+        self.pending.pop(writer, None)
+        if writer.written == 0:
+            logging.info(f'Skipping {writer.file} - 0 hits')
+        else:
+            logging.info(f'Finished {writer.file} - {writer.written} tweets')
+
+
+def process(args, file, scheduler):
+    if os.path.exists(os.path.join(args.tbl_output, file[:-3] + '.tbl')):
+        logging.info(f'Skipping {file} - already processed')
+        return
+    logging.info(f'Processing {file}')
+    writer = AnnotationWriter(args, file)
+    resume_index = writer.next_index
+    for index, tweet in enumerate(read_tweets(args, file)):
+        if index >= resume_index and tweet['lang_z'] == 1:
+            scheduler.add(writer, index, tweet)
+    scheduler.finish(writer)
+
+
+def set_up_model(args, use_multiprocessing=True):
     model_args = ClassificationArgs()
     model_args.regression = True
     model_args.manual_seed = args.manual_seed
     # model_args.overwrite_output_dir = True
     model_args.save_steps = -1
     model_args.eval_batch_size = 32
-    model_args.use_multiprocessing_for_evaluation = True
+    # pool workers are daemonic and can not start their own tokenization pools
+    model_args.use_multiprocessing_for_evaluation = use_multiprocessing
     # model_args.use_cached_eval_features = True
     model_args.evaluate_during_training = True
     model_args.evaluate_during_training_verbose = True,
@@ -82,31 +425,142 @@ def set_up_model(args):
     return model
 
 
-def predict(model, raw_input):
-    test_df = pd.DataFrame([[line[0].lower()] for line in raw_input])
+def load_model(args, use_multiprocessing=True):
+    if args.backend == 'onnx':
+        from onnx_backend import OnnxModel
+
+        model = OnnxModel(args.onnx_model, quantized=args.quantize, threads=torch.get_num_threads())
+    elif args.backend == 'remote':
+        from scoring_server import RemoteModel
+
+        model = RemoteModel(args.server_url)
+    else:
+        model = set_up_model(args, use_multiprocessing)
+
+    if args.cascade_model:
+        from cascade import CascadeModel
+
+        model = CascadeModel(model, args.cascade_model, args.cascade_vectorizer, args.cascade_bands,
+                             args.cascade_margin, args.bucket_size)
+    return model
+
+
+def token_lengths(model, texts):
+    encoded = model.tokenizer(texts, add_special_tokens=True, truncation=True, max_length=model.args.max_seq_length)
+    return np.array([len(input_ids) for input_ids in encoded['input_ids']])
+
+
+def predict(model, texts, bucket_size=0):
+    test_df = pd.DataFrame([[text.lower()] for text in texts])
     test_df.columns = ["text"]
 
-    # Predict test_results and save file for hand checking
-    predictions, raw_outputs = model.predict(test_df['text'])
+    # models without a tokenizer (remote, cascade) batch on their own
+    if bucket_size <= 0 or not hasattr(model, 'tokenizer'):
+        # Predict test_results and save file for hand checking
+        predictions, raw_outputs = model.predict(test_df['text'])
+        return predictions
+
+    # sort by token length, so that batches are padded only up to their longest tweet
+    lower_texts = test_df['text'].tolist()
+    lengths = token_lengths(model, lower_texts)
+    order = np.argsort(lengths, kind='stable')
+    predictions = np.empty(len(lower_texts))
+    max_seq_length = model.args.max_seq_length
+    try:
+        for start in range(0, len(order), bucket_size):
+            bucket = order[start:start + bucket_size]
+            model.args.max_seq_length = int(lengths[bucket[-1]])
+            bucket_predictions, raw_outputs = model.predict([lower_texts[i] for i in bucket])
+            # restore original order
+            predictions[bucket] = np.atleast_1d(bucket_predictions)
+    finally:
+        model.args.max_seq_length = max_seq_length
 
     return predictions
 
 
+def init_worker(args):
+    global _worker_model
+    # split cores between workers instead of letting each of them use all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    _worker_model = load_model(args, use_multiprocessing=False)
+
+
+def process_shard(args, files):
+    scheduler = BatchScheduler(args, _worker_model)
+    for file in files:
+        process(args, file, scheduler)
+    scheduler.close()
+
+
+def shard_files(args, files):
+    # balance shards by input size, largest files first
+    shards = [[] for _ in range(args.workers)]
+    sizes = [0] * args.workers
+    for file in sorted(files, key=lambda f: os.path.getsize(os.path.join(args.json_input, f)), reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i].append(file)
+        sizes[i] += os.path.getsize(os.path.join(args.json_input, file))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def add_model_arguments(parser):
+    parser.add_argument('--bert_model', default='data/best_models/sloberta_10/',
+                        help='path to bert model used for predictions')
+    parser.add_argument('--bert_type', default='camembert',
+                        help='Type of bert used.')
+    parser.add_argument('--backend', choices=['pytorch', 'onnx', 'remote'], default='pytorch',
+                        help='Run predictions with simpletransformers (pytorch), with onnxruntime on CPU or on a '
+                             'running scoring_server.py (remote).')
+    parser.add_argument('--onnx_model', default='data/onnx_models/sloberta_10/',
+                        help='Folder with model exported by onnx_backend.py export (onnx backend only).')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Use the int8 quantized ONNX model (onnx backend only).')
+    parser.add_argument('--server_url', default='http://127.0.0.1:8765',
+                        help='URL of scoring_server.py (remote backend only).')
+    parser.add_argument('--cascade_model', default='',
+                        help='Path to a char n-gram model from regression_svm (e.g. Ridge_default.pkl). If set, it '
+                             'scores all tweets and only those near or inside cascade_bands are scored by bert, '
+                             'the rest keep the cheap score.')
+    parser.add_argument('--cascade_vectorizer', default='',
+                        help='Path to vectorizer saved by regression_svm with cascade_model.')
+    parser.add_argument('--cascade_bands', default='0.2-0.3,0.3-0.4,0.4-0.5,0.5+',
+                        help='Bands of interest of postprocess_scraped_data.')
+    parser.add_argument('--cascade_margin', type=float, default=0.05,
+                        help='Tweets with cheap score within this distance of a band are escalated as well.')
+
+
 def main(args):
     random.seed(args.manual_seed)
     if args.overwrite:
         shutil.rmtree(args.json_output)
         shutil.rmtree(args.tbl_output)
+        if args.parquet_output:
+            shutil.rmtree(args.parquet_output, ignore_errors=True)
     os.makedirs(os.path.dirname(args.json_output), exist_ok=True)
     os.makedirs(os.path.dirname(args.tbl_output), exist_ok=True)
+    if args.parquet_output:
+        os.makedirs(args.parquet_output, exist_ok=True)
 
-    model = set_up_model(args)
-    for file in sorted(os.listdir(args.json_input)):
-        process(args, file, model)
+    files = sorted(os.listdir(args.json_input))
+    if args.workers > 1:
+        # already processed files are still skipped in process, they are only left out of size balancing
+        todo = [file for file in files if not os.path.exists(os.path.join(args.tbl_output, file[:-3] + '.tbl'))]
+        with multiprocessing.get_context('spawn').Pool(args.workers, initializer=init_worker,
+                                                        initargs=(args,)) as pool:
+            pool.starmap(process_shard, [(args, shard) for shard in shard_files(args, todo)], chunksize=1)
+    else:
+        model = load_model(args)
+        scheduler = BatchScheduler(args, model)
+        for file in files:
+            process(args, file, scheduler)
+        scheduler.close()
 
     if args.sample_size > 0:
         all_tbl_outputs = []
         for file in sorted(os.listdir(args.tbl_output)):
+            if not file.endswith('.tbl') or file == 'sample.tbl':
+                continue
             with open(os.path.join(args.tbl_output, file), 'r') as rf:
                 all_tbl_outputs += [line for line in rf.readlines()]
 
@@ -127,14 +581,32 @@ if __name__ == '__main__':
                         help='input file in (gz or xml currently). If none, then just database is loaded')
     parser.add_argument('--overwrite', action='store_true',
                         help='input file in (gz or xml currently). If none, then just database is loaded')
-    parser.add_argument('--bert_model', default='data/best_models/sloberta_10/',
-                        help='path to bert model used for predictions')
     parser.add_argument('--manual_seed', type=int, default=23,
                         help='manual seed')
-    parser.add_argument('--bert_type', default='camembert',
-                        help='Type of bert used.')
+    add_model_arguments(parser)
     parser.add_argument('--sample_size', type=int, default=0,
                         help='Randomly obtain sample_size number of examples from tbl_output.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Parse input files one tweet at a time instead of loading whole files into memory.')
+    parser.add_argument('--batch_size', type=int, default=4096,
+                        help='Number of Slovene tweets in a prediction batch. Batches are filled across input files.')
+    parser.add_argument('--checkpoint_every', type=int, default=10000,
+                        help='Sync output to disk and store a resume checkpoint after this many written tweets.')
+    parser.add_argument('--bucket_size', type=int, default=0,
+                        help='If > 0, sort each batch by token length and predict it in buckets of this size, '
+                             'each padded only to its longest tweet. Should be a multiple of eval_batch_size (32).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes input files are sharded across. Each loads its own model and '
+                             'uses cpu_count / workers torch threads.')
+    parser.add_argument('--cache', default='',
+                        help='Path to SQLite prediction cache. Tweets with already scored text skip the model.')
+    parser.add_argument('--cache_size', type=int, default=50000000,
+                        help='Maximum number of cached predictions, least recently used are evicted.')
+    parser.add_argument('--output_format', choices=['json', 'jsonl'], default='json',
+                        help='Write annotated tweets in json_output as a JSON array or as JSON lines.')
+    parser.add_argument('--parquet_output', default='',
+                        help='If set, also write id, text, standardness and source file of annotated tweets to '
+                             'Parquet files in this folder (requires pyarrow).')
     args = parser.parse_args()
 
     start = time.time()
@@ -1,36 +1,166 @@
 import argparse
+import hashlib
+import json
 import os
 import sys
 import time
 from shutil import copyfile
 
 from simpletransformers.classification import ClassificationModel, ClassificationArgs
+import numpy as np
 import pandas as pd
 import logging
+import torch
 from scipy import stats
+from torch.utils.data import TensorDataset
+
+from feature_store import features_key, load_or_tokenize
+from run_records import dataset_name, make_record, peak_rss_mb, write_record
 
 
 logging.basicConfig(level=logging.INFO)
 transformers_logger = logging.getLogger("transformers")
 transformers_logger.setLevel(logging.WARNING)
 
+# named training profiles, single settings can be overridden from command line
+PROFILES = {
+    # settings used for models in README
+    'default': {'precision': 'fp32', 'train_batch_size': 16, 'gradient_accumulation_steps': 1,
+                'max_seq_length': 128, 'dataloader_num_workers': 0},
+    'fp16': {'precision': 'fp16', 'train_batch_size': 32, 'gradient_accumulation_steps': 1,
+             'max_seq_length': 128, 'dataloader_num_workers': 4},
+    'bf16': {'precision': 'bf16', 'train_batch_size': 32, 'gradient_accumulation_steps': 1,
+             'max_seq_length': 128, 'dataloader_num_workers': 4},
+    # same effective batch size as default with a quarter of activation memory
+    'low_memory': {'precision': 'fp16', 'train_batch_size': 4, 'gradient_accumulation_steps': 4,
+                   'max_seq_length': 128, 'dataloader_num_workers': 2},
+    # tweets rarely need more than 64 tokens
+    'short': {'precision': 'fp16', 'train_batch_size': 32, 'gradient_accumulation_steps': 1,
+              'max_seq_length': 64, 'dataloader_num_workers': 4},
+}
 
-def main(args):
-    # Preparing train data
+
+def peak_memory():
+    """Name and value in MB of peak memory, CUDA peak is reset every epoch, peak RSS on CPU is of the whole process."""
+    if torch.cuda.is_available():
+        return 'peak_cuda_memory_mb', torch.cuda.max_memory_allocated() / 1024 ** 2
+    return 'process_peak_rss_mb', peak_rss_mb()
+
+
+def tokenizer_fingerprint(tokenizer):
+    # independent of the folder tokenizer was loaded from, so that fine-tuned models share features of their base
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return type(tokenizer).__name__ + '-' + hashlib.sha1(vocab.encode('utf8')).hexdigest()
+
+
+def example_texts_labels(examples):
+    # newer simpletransformers pass (texts, labels), older ones a list of InputExample
+    if isinstance(examples, tuple):
+        return list(examples[0]), list(examples[-1])
+    return [example.text_a for example in examples], [example.label for example in examples]
+
+
+class ProfiledClassificationModel(ClassificationModel):
+    """ClassificationModel that logs training throughput and peak memory after every epoch.
+
+    simpletransformers evaluates on dev at the end of every epoch, so eval_model calls during training mark epoch
+    boundaries. With bf16 precision training runs under torch autocast, which simpletransformers lacks.
+
+    If features_cache is set, texts are tokenized once and stored there as memory mapped arrays, keyed by tokenizer
+    and data hash, instead of being tokenized again on every dev evaluation and run.
+    """
+    precision = 'fp32'
+    epoch_start = None
+    features_cache = None
+    # called with epoch number and dev results after every epoch
+    epoch_callback = None
+
+    def load_and_cache_examples(self, examples, *args, **kwargs):
+        if not self.features_cache or self.args.sliding_window:
+            return super().load_and_cache_examples(examples, *args, **kwargs)
+        texts, labels = example_texts_labels(examples)
+        params = {'tokenizer': tokenizer_fingerprint(self.tokenizer), 'model_type': self.args.model_type,
+                  'max_seq_length': self.args.max_seq_length}
+
+        def tokenize():
+            encoded = self.tokenizer(texts, padding='max_length', truncation=True,
+                                     max_length=self.args.max_seq_length, return_token_type_ids=True)
+            # int64 and float32, as expected by the model, so tensors below share memory with mapped files
+            return {
+                'input_ids': np.array(encoded['input_ids'], dtype=np.int64),
+                'attention_mask': np.array(encoded['attention_mask'], dtype=np.int64),
+                'token_type_ids': np.array(encoded['token_type_ids'], dtype=np.int64),
+                'labels': np.array(labels, dtype=np.float32),
+            }
+        arrays = load_or_tokenize(self.features_cache, features_key([{'text': texts, 'labels': labels}], params),
+                                  tokenize)
+        # same order of tensors as simpletransformers' own datasets
+        return TensorDataset(*[torch.from_numpy(arrays[name]) for name in
+                               ['input_ids', 'attention_mask', 'token_type_ids', 'labels']])
+
+    def train_model(self, train_df, *args, **kwargs):
+        self.epoch = 0
+        self.epoch_samples = len(train_df)
+        self.epoch_stats = []
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.epoch_start = time.time()
+        try:
+            if self.precision == 'bf16':
+                with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                    return super().train_model(train_df, *args, **kwargs)
+            return super().train_model(train_df, *args, **kwargs)
+        finally:
+            self.epoch_start = None
+
+    def eval_model(self, *args, **kwargs):
+        if self.epoch_start is not None:
+            self.epoch += 1
+            duration = time.time() - self.epoch_start
+            memory_name, memory_mb = peak_memory()
+            self.epoch_stats.append({'epoch': self.epoch, 'train_s': duration,
+                                     'samples_per_s': self.epoch_samples / duration, memory_name: memory_mb})
+            logging.info(f'Epoch {self.epoch}: {self.epoch_samples / duration:.1f} samples/s, '
+                         f'{memory_name} {memory_mb:.0f}')
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+        result = super().eval_model(*args, **kwargs)
+        if self.epoch_start is not None:
+            if self.epoch_callback is not None:
+                self.epoch_callback(self.epoch, result[0])
+            # dev evaluation does not count into training time
+            self.epoch_start = time.time()
+        return result
+
+
+def training_profile(args):
+    profile = dict(PROFILES[args.profile])
+    for key in profile:
+        if getattr(args, key) is not None:
+            profile[key] = getattr(args, key)
+    if profile['precision'] == 'fp16' and not torch.cuda.is_available():
+        # fp16 of simpletransformers uses torch.cuda.amp, which is disabled without CUDA and silently trains in fp32
+        logging.warning('fp16 precision needs CUDA, training with bf16 autocast on CPU instead')
+        profile['precision'] = 'bf16'
+    logging.info(f'Training profile {args.profile}: {profile}')
+    return profile
+
+
+def read_data(input_path, final_prediction):
     train_data = []
     dev_data = []
     test_data = []
-    for filename in os.listdir(args.input):
+    for filename in sorted(os.listdir(input_path)):
         if filename.find('test') == -1 and filename.find('dev') == -1:
             data = train_data
         elif filename.find('test') == -1:
             data = dev_data
         else:
-            if args.final_prediction:
+            if final_prediction:
                 data = dev_data
             else:
                 data = test_data
-        with open(f'{args.input}/{filename}', 'r') as f:
+        with open(f'{input_path}/{filename}', 'r') as f:
             data += [[line.strip().split('\t')[0].lower(), float(line.strip().split('\t')[1])] for line in f.readlines()]
 
     train_df = pd.DataFrame(train_data)
@@ -41,7 +171,10 @@ def main(args):
 
     test_df = pd.DataFrame(test_data)
     test_df.columns = ["text", "labels"]
+    return train_df, eval_df, test_df
+
 
+def train(args, train_df, eval_df, test_df, epoch_callback=None):
     model_dir = os.path.join(args.model, args.name)
     best_model_dir = os.path.join(args.best_model, args.name)
 
@@ -51,9 +184,18 @@ def main(args):
     model_args.num_train_epochs = args.epochs
     model_args.regression = True
     model_args.manual_seed = args.manual_seed
+    model_args.learning_rate = args.learning_rate
     # model_args.overwrite_output_dir = True
     model_args.save_steps = -1
-    model_args.train_batch_size = 16
+    profile = training_profile(args)
+    model_args.train_batch_size = profile['train_batch_size']
+    model_args.gradient_accumulation_steps = profile['gradient_accumulation_steps']
+    model_args.max_seq_length = profile['max_seq_length']
+    model_args.dataloader_num_workers = profile['dataloader_num_workers']
+    model_args.fp16 = profile['precision'] == 'fp16'
+    if args.num_hidden_layers:
+        # keeps only the first layers of the pretrained encoder
+        model_args.config = {'num_hidden_layers': args.num_hidden_layers}
     model_args.evaluate_during_training = True
     model_args.evaluate_during_training_verbose = True,
     model_args.evaluate_during_training_steps = -1
@@ -65,58 +207,103 @@ def main(args):
     pearsonr_func = lambda x, y: stats.pearsonr(x, y)[0]
 
     # Create a ClassificationModel
-    model = ClassificationModel(
+    model = ProfiledClassificationModel(
         args.bert_type,
         args.bert,
         num_labels=1,
-        args=model_args
+        args=model_args,
+        use_cuda=torch.cuda.is_available()
     )
+    model.precision = profile['precision']
+    model.features_cache = args.features_cache
+    model.epoch_callback = epoch_callback
 
     # Train the model
+    start = time.time()
     model.train_model(train_df, output_dir=model_dir, eval_df=eval_df, pearsonr=pearsonr_func, spearmanr=spearmanr_func)
+    train_time = time.time() - start
+    epoch_stats = model.epoch_stats
 
     # Load best model
-    model = ClassificationModel(
+    model = ProfiledClassificationModel(
         args.bert_type,
         best_model_dir,
         num_labels=1,
-        args=model_args
+        args=model_args,
+        use_cuda=torch.cuda.is_available()
     )
+    model.features_cache = args.features_cache
 
     # Evaluate and save test_results
+    start = time.time()
     result, model_outputs, wrong_predictions = model.eval_model(test_df, pearsonr=pearsonr_func, spearmanr=spearmanr_func)
     with open(os.path.join(best_model_dir, 'test_results.txt'), 'w') as f:
         for key, val in result.items():
             f.write(f'{key} = {val}\n')
 
-    # Predict test_results and save file for hand checking
-    predictions, raw_outputs = model.predict(test_df['text'])
+    # Save predictions for hand checking, regression outputs of eval_model are the predictions, so test set does not
+    # need another forward pass
+    predictions = np.squeeze(model_outputs)
     with open(os.path.join(best_model_dir, 'predictions.tbl'), 'w') as f:
         for text, real_pred, program_pred in zip(test_df['text'], test_df['labels'], predictions):
             f.write(f'{text}\t{real_pred}\t{program_pred}\n')
 
+    write_record(best_model_dir, make_record(
+        args.name, 'bert', args.bert, dataset_name(args.input), features_key([train_df, eval_df, test_df], {}),
+        result['pearsonr'], result['spearmanr'],
+        {'train_s': train_time, 'test_s': time.time() - start, 'epochs': epoch_stats},
+        dict(vars(args), profile=profile)))
+    return result
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='BERT normalization regression.')
-    parser.add_argument('input',
-                        help='Path to input files.')
+
+def main(args):
+    train(args, *read_data(args.input, args.final_prediction))
+
+
+def add_training_arguments(parser):
     parser.add_argument('--bert',
                         help='Path to BERT/bert name.')
     parser.add_argument('--bert_type', default='camembert',
                         help='Type of bert used.')
-    parser.add_argument('--epochs', type=int, default=10,
-                        help='Epochs number.')
     parser.add_argument('--model', default='data/custom_models',
                         help='Path to stored models.')
     parser.add_argument('--best_model', default='data/best_models/',
                         help='Path to best models folder.')
-    parser.add_argument('--name',
-                        help='Name under which model and best models will be saved.')
     parser.add_argument('--final_prediction', action='store_true',
                         help='Merge train and test under train.')
+    parser.add_argument('--profile', choices=list(PROFILES), default='default',
+                        help='Named training profile, settings below override its values.')
+    parser.add_argument('--precision', choices=['fp32', 'fp16', 'bf16'],
+                        help='Training precision, fp16 and bf16 use autocast. fp16 falls back to bf16 without CUDA.')
+    parser.add_argument('--train_batch_size', type=int,
+                        help='Train batch size.')
+    parser.add_argument('--gradient_accumulation_steps', type=int,
+                        help='Number of batches gradients are accumulated over before each optimizer step.')
+    parser.add_argument('--max_seq_length', type=int,
+                        help='Maximum number of tokens of a text.')
+    parser.add_argument('--dataloader_num_workers', type=int,
+                        help='Number of dataloader worker processes.')
+    parser.add_argument('--num_hidden_layers', type=int,
+                        help='If set, the model is built from the first num_hidden_layers layers of bert only.')
+    parser.add_argument('--features_cache', default='data/bert_features/',
+                        help='Folder with tokenized texts, keyed by tokenizer and hash of input data. '
+                             'Empty string disables it.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='BERT normalization regression.')
+    parser.add_argument('input',
+                        help='Path to input files.')
+    parser.add_argument('--name',
+                        help='Name under which model and best models will be saved.')
+    parser.add_argument('--epochs', type=int, default=10,
+                        help='Epochs number.')
+    parser.add_argument('--learning_rate', type=float, default=4e-5,
+                        help='Learning rate.')
     parser.add_argument('--manual_seed', type=int, default=23,
                         help='Manual seed.')
+    add_training_arguments(parser)
     args = parser.parse_args()
 
     start = time.time()
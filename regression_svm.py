@@ -3,14 +3,21 @@ import os
 import time
 
 import joblib
+from joblib import Parallel, delayed
 import pandas as pd
 import logging
-from scipy import stats
-from sklearn.feature_extraction.text import CountVectorizer
+from scipy import sparse, stats
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfTransformer
+from sklearn.kernel_approximation import Nystroem, RBFSampler
 from sklearn.linear_model import Ridge
-from sklearn.svm import SVR
+from sklearn.pipeline import make_pipeline
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.svm import SVR, LinearSVR
 import numpy as np
 
+from feature_store import features_key, load_or_extract
+from run_records import dataset_name, make_record, peak_rss_mb, write_record
+
 seed = 23
 
 logging.basicConfig(level=logging.INFO)
@@ -18,32 +25,77 @@ transformers_logger = logging.getLogger("transformers")
 transformers_logger.setLevel(logging.WARNING)
 
 
-def create_models(classifier, fname, X_train, y_train, X_test, y_true):
+def scale_gamma(X):
+    # gamma='scale' of SVR, which kernel approximations do not support
+    variance = X.multiply(X).mean() - X.mean() ** 2
+    return 1.0 / (X.shape[1] * variance) if variance > 0 else 1.0
+
+
+# model factories, called with args and train features
+MODELS = {
+    'Ridge': lambda args, X: Ridge(),
+    'SVR_rbf': lambda args, X: SVR(verbose=True),
+    'SVR_linear': lambda args, X: SVR(verbose=True, kernel='linear'),
+    'SVR_poly': lambda args, X: SVR(verbose=True, kernel='poly'),
+    # near-linear time approximations of SVR_rbf and SVR_linear
+    'Nystroem_rbf': lambda args, X: make_pipeline(
+        Nystroem(gamma=scale_gamma(X), n_components=args.n_components, random_state=seed),
+        LinearSVR(random_state=seed, max_iter=10000)),
+    # RBFSampler stores a dense n_features x n_components matrix, n-gram features are randomly projected first (sparse
+    # projection preserves distances, so gamma of original features still applies)
+    'RFF_rbf': lambda args, X: make_pipeline(
+        SparseRandomProjection(n_components=args.projection_components, dense_output=True, random_state=seed),
+        RBFSampler(gamma=scale_gamma(X), n_components=args.n_components, random_state=seed),
+        LinearSVR(random_state=seed, max_iter=10000)),
+    'LinearSVR': lambda args, X: LinearSVR(random_state=seed, max_iter=10000),
+}
+DEFAULT_MODELS = ['Ridge', 'SVR_rbf', 'SVR_linear', 'SVR_poly']
+
+
+def create_models(classifier, fname, X_train, y_train, X_test, y_true, output, compress, run):
     classifier.random_state = seed
     print('###############################################################')
     print('Starting calculation..')
+    start = time.time()
     model = classifier.fit(X_train, y_train)
-    _ = joblib.dump(model, os.path.join(args.output, fname), compress=9)
+    fit_time = time.time() - start
+    _ = joblib.dump(model, os.path.join(output, fname), compress=compress)
+    start = time.time()
     y_test = model.predict(X_test)
+    predict_time = time.time() - start
 
     pearson = stats.pearsonr(y_test, y_true)
     spearman = stats.spearmanr(y_test, y_true)
-    with open(os.path.join(args.output, fname) + '.result', 'w') as f:
+    with open(os.path.join(output, fname) + '.result', 'w') as f:
         f.write(f'pearson={str(pearson)}|spearman={str(spearman)}')
-    os.path.join(args.output, fname)
     print(f'{fname} - Pearson: {pearson} | Spearman: {spearman}')
 
+    write_record(output, make_record(
+        fname[:-4], 'svm', run['model'], run['dataset'], run['dataset_hash'], pearson[0], spearman[0],
+        {'fit_s': fit_time, 'predict_s': predict_time, 'features_s': run['features_s']},
+        dict(run['hyperparameters'], params=classifier.get_params())))
 
-def main(args):
-    # Preparing train data
+
+def feature_mode(args):
+    # count features without tf-idf keep their original model names
+    mode = args.vectorizer + ('_tfidf' if args.tfidf else '')
+    return 'default' if mode == 'count' else mode
+
+
+def transform_in_chunks(vectorizer, texts, chunk_size):
+    return sparse.vstack([vectorizer.transform(texts[start:start + chunk_size])
+                          for start in range(0, len(texts), chunk_size)]).tocsr()
+
+
+def read_data(input_path):
     train_data = []
     eval_data = []
-    for filename in os.listdir(args.input):
+    for filename in sorted(os.listdir(input_path)):
         if filename.find('test') == -1:
             data = train_data
         else:
             data = eval_data
-        with open(f'{args.input}/{filename}', 'r') as f:
+        with open(f'{input_path}/{filename}', 'r') as f:
             data += [[line.strip().split('\t')[0], float(line.strip().split('\t')[1])] for line in f.readlines()]
 
     train_df = pd.DataFrame(train_data)
@@ -51,28 +103,84 @@ def main(args):
 
     eval_df = pd.DataFrame(eval_data)
     eval_df.columns = ["text", "labels"]
+    return train_df, eval_df
+
+
+def load_features(args, train_df, eval_df):
+    def extract():
+        train_texts = train_df['text'].str.lower()
+        test_texts = eval_df['text'].str.lower()
+        if args.vectorizer == 'hashing':
+            # stateless, so texts are transformed in chunks and memory does not grow with the vocabulary
+            vectorizer = HashingVectorizer(ngram_range=(3, 8), analyzer='char', n_features=args.n_features,
+                                           alternate_sign=False, norm=None)
+            X_train = transform_in_chunks(vectorizer, train_texts, args.chunk_size)
+            X_test = transform_in_chunks(vectorizer, test_texts, args.chunk_size)
+        else:
+            vectorizer = CountVectorizer(ngram_range=(3, 8), analyzer='char')
+            X_train = vectorizer.fit_transform(train_texts)
+            X_test = vectorizer.transform(test_texts)
+        if args.tfidf:
+            tfidf = TfidfTransformer()
+            X_train = tfidf.fit_transform(X_train)
+            X_test = tfidf.transform(X_test)
+            vectorizer = make_pipeline(vectorizer, tfidf)
+        return {'train': X_train, 'test': X_test}, vectorizer
+
+    # features are stored once per data and reused (memory mapped) by later runs
+    params = {'vectorizer': args.vectorizer, 'ngram_range': [3, 8], 'analyzer': 'char', 'lowercase': True,
+              'tfidf': args.tfidf}
+    if args.vectorizer == 'hashing':
+        params['n_features'] = args.n_features
+    features, vectorizer = load_or_extract(args.features, features_key([train_df, eval_df], params), extract)
+    logging.info(f'Features: {features["train"].shape[1]} columns, '
+                 f'{features["train"].nnz + features["test"].nnz} non-zero values, '
+                 f'peak memory {peak_rss_mb():.0f} MB')
+    return features['train'], features['test'], vectorizer
+
+
+def add_kernel_approximation_arguments(parser):
+    parser.add_argument('--n_components', type=int, default=1000,
+                        help='Number of features of kernel approximations (Nystroem_rbf, RFF_rbf).')
+    parser.add_argument('--projection_components', type=int, default=1024,
+                        help='Number of features n-gram features are projected to before RFF_rbf.')
+
+
+def add_feature_arguments(parser):
+    parser.add_argument('--features', default='data/features/',
+                        help='Folder with stored feature matrices, keyed by hash of input data and extraction '
+                             'parameters.')
+    parser.add_argument('--vectorizer', choices=['count', 'hashing'], default='count',
+                        help='Char n-gram counts with a fitted vocabulary (count) or feature hashing into a fixed '
+                             'number of columns (hashing).')
+    parser.add_argument('--n_features', type=int, default=2 ** 20,
+                        help='Number of columns of hashing vectorizer.')
+    parser.add_argument('--tfidf', action='store_true',
+                        help='Apply TF-IDF weighting to n-gram features.')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help='Number of texts hashed at once with hashing vectorizer.')
 
 
-    ngram_counter = CountVectorizer(ngram_range=(3, 8), analyzer='char')
-
-
-    X_train = ngram_counter.fit_transform(train_df['text'].str.lower())
+def main(args):
+    # Preparing train data
+    train_df, eval_df = read_data(args.input)
+    start = time.time()
+    X_train, X_test, vectorizer = load_features(args, train_df, eval_df)
+    run = {'dataset': dataset_name(args.input), 'dataset_hash': features_key([train_df, eval_df], {}),
+           'features_s': time.time() - start, 'hyperparameters': vars(args)}
     y_train = train_df['labels']
-    X_test = ngram_counter.transform(eval_df['text'].str.lower())
     y_true = eval_df['labels']
 
+    mode = feature_mode(args)
+    # needed to apply saved models on new texts
+    joblib.dump(vectorizer, os.path.join(args.output, f'vectorizer_{mode}.pkl'), compress=args.compress)
 
-    classifier = Ridge()
-    create_models(classifier, 'Ridge_default.pkl', X_train, y_train, X_test, y_true)
-
-    classifier = SVR(verbose=True)
-    create_models(classifier, 'SVR_rbf_default.pkl', X_train, y_train, X_test, y_true)
-
-    classifier = SVR(verbose=True, kernel='linear')
-    create_models(classifier, 'SVR_linear_default.pkl', X_train, y_train, X_test, y_true)
-
-    classifier = SVR(verbose=True, kernel='poly')
-    create_models(classifier, 'SVR_poly_default.pkl', X_train, y_train, X_test, y_true)
+    # loky passes memory mapped feature matrices to workers by reference, without copying them
+    Parallel(n_jobs=args.jobs, backend='loky')(
+        delayed(create_models)(MODELS[name](args, X_train), f'{name}_{mode}.pkl', X_train, y_train, X_test, y_true,
+                               args.output, args.compress, dict(run, model=name))
+        for name in args.models.split(','))
+    logging.info(f'Peak memory {peak_rss_mb():.0f} MB')
 
 
 if __name__ == '__main__':
@@ -82,6 +190,14 @@ if __name__ == '__main__':
                         help='input file in (gz or xml currently). If none, then just database is loaded')
     parser.add_argument('--output',
                         help='input file in (gz or xml currently). If none, then just database is loaded')
+    add_feature_arguments(parser)
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS),
+                        help=f'Comma separated models to train, out of {",".join(MODELS)}.')
+    add_kernel_approximation_arguments(parser)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of models trained in parallel (-1 for all cores).')
+    parser.add_argument('--compress', type=int, default=3,
+                        help='Compression level (0-9) of saved models.')
     args = parser.parse_args()
 
     np.random.seed(seed)
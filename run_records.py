@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import resource
+import sqlite3
+import time
+
+RECORD_SUFFIX = '.run.json'
+# README sections, in this order
+DATASET_LANGUAGES = {'janes-norm': 'Slovene', 'reldi-hr': 'Croatian', 'reldi-sr': 'Serbian'}
+FAMILIES = ['svm', 'bert']
+# README rows and their order, svm runs by name (count features), bert runs by pretrained model
+README_MODELS = {
+    'svm': {'Ridge_default': 'Ridge', 'SVR_poly_default': 'SVR-poly', 'SVR_linear_default': 'SVR-linear',
+            'SVR_rbf_default': 'SVR-rbf'},
+    'bert': {'bert-base-multilingual-cased': 'Multilingual BERT', 'EMBEDDIA/crosloengual-bert': 'CroSloEng BERT',
+             'EMBEDDIA/sloberta': 'sloBERTa', 'classla/bcms-bertic': 'BERTić'},
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def dataset_name(input_path):
+    return os.path.basename(os.path.normpath(input_path))
+
+
+def dataset_order(dataset):
+    datasets = list(DATASET_LANGUAGES)
+    return datasets.index(dataset) if dataset in datasets else len(datasets), dataset
+
+
+def readme_model(family, name, model, hyperparameters):
+    # sweep trials and distilled students are regression_bert runs as well, told apart by arguments of their scripts
+    if 'learning_rates' in hyperparameters or 'distill_data' in hyperparameters:
+        return None
+    return README_MODELS.get(family, {}).get(name if family == 'svm' else model)
+
+
+def make_record(name, family, model, dataset, dataset_hash, pearson, spearman, timings, hyperparameters):
+    return {
+        'name': name,
+        'family': family,
+        'model': model,
+        'dataset': dataset,
+        'dataset_hash': dataset_hash,
+        'metrics': {'pearson': float(pearson), 'spearman': float(spearman)},
+        'timings': timings,
+        'hyperparameters': hyperparameters,
+        'created': time.time(),
+    }
+
+
+def write_record(folder, record):
+    path = os.path.join(folder, record['name'] + RECORD_SUFFIX)
+    with open(path + '.tmp', 'w') as f:
+        # hyperparameters are taken from argparse namespaces and may hold values json does not know
+        json.dump(record, f, indent=2, sort_keys=True, default=str)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_record(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class RunIndex(object):
+    """SQLite index over run records stored under a results folder.
+
+    update only reads records added or changed since the previous update, so it stays cheap with thousands of runs.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS runs (path TEXT PRIMARY KEY, mtime REAL NOT NULL, '
+                                'name TEXT, family TEXT, model TEXT, dataset TEXT, dataset_hash TEXT, '
+                                'pearson REAL, spearman REAL, created REAL, record TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS runs_dataset ON runs (dataset, spearman)')
+        self.connection.commit()
+
+    def update(self, root):
+        indexed = dict(self.connection.execute('SELECT path, mtime FROM runs'))
+        found = set()
+        changed = 0
+        for folder, _, files in os.walk(root):
+            for file in files:
+                if not file.endswith(RECORD_SUFFIX):
+                    continue
+                path = os.path.join(folder, file)
+                found.add(path)
+                mtime = os.path.getmtime(path)
+                if indexed.get(path) == mtime:
+                    continue
+                record = read_record(path)
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, mtime, record['name'], record['family'], record['model'], record['dataset'],
+                     record['dataset_hash'], record['metrics']['pearson'], record['metrics']['spearman'],
+                     record['created'], json.dumps(record)))
+                changed += 1
+        removed = [(path,) for path in indexed if path not in found]
+        self.connection.executemany('DELETE FROM runs WHERE path = ?', removed)
+        self.connection.commit()
+        logging.info(f'Run index: {changed} records added or updated, {len(removed)} removed, {len(found)} total')
+
+    def runs(self, dataset=None):
+        """Latest run of every name (of dataset), ordered by dataset, family and name."""
+        query = ('SELECT name, family, model, dataset, pearson, spearman, path FROM runs r WHERE created = '
+                 '(SELECT MAX(created) FROM runs WHERE name = r.name AND dataset = r.dataset)')
+        params = []
+        if dataset is not None:
+            query += ' AND dataset = ?'
+            params.append(dataset)
+        rows = self.connection.execute(query, params).fetchall()
+        return sorted(rows, key=lambda row: (dataset_order(row[3]),
+                                             FAMILIES.index(row[1]) if row[1] in FAMILIES else len(FAMILIES), row[0]))
+
+    def readme_tables(self):
+        """README tables with the latest run of every README model, other runs (e.g. sweep trials) are left out."""
+        rows = {}
+        for name, family, model, dataset, pearson, spearman, record in self.connection.execute(
+                'SELECT name, family, model, dataset, pearson, spearman, record FROM runs ORDER BY created'):
+            readme_name = readme_model(family, name, model, json.loads(record)['hyperparameters'])
+            if readme_name is not None:
+                rows[dataset, readme_name] = (pearson, spearman)
+        readme_names = [readme_name for family in FAMILIES for readme_name in README_MODELS[family].values()]
+        sections = []
+        for dataset in sorted({dataset for dataset, _ in rows}, key=dataset_order):
+            dataset_rows = [(readme_name, *rows[dataset, readme_name]) for readme_name in readme_names
+                            if (dataset, readme_name) in rows]
+            best_pearson = max(row[1] for row in dataset_rows)
+            best_spearman = max(row[2] for row in dataset_rows)
+            lines = [f'### {DATASET_LANGUAGES.get(dataset, dataset)}', '',
+                     '| model | dataset | Pearson Correlation | Spearman Correlation |',
+                     '| --- | --- | --- | --- |']
+            for name, pearson, spearman in dataset_rows:
+                pearson_cell = f'**{pearson:.4f}**' if pearson == best_pearson else f'{pearson:.4f}'
+                spearman_cell = f'**{spearman:.4f}**' if spearman == best_spearman else f'{spearman:.4f}'
+                lines.append(f'| {name} | {dataset} | {pearson_cell} | {spearman_cell} |')
+            sections.append('\n'.join(lines))
+        return '\n\n\n'.join(sections) + '\n'
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,204 @@
+import argparse
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from prediction_cache import model_fingerprint
+from process_scraped_data import add_model_arguments, load_model, predict
+
+logging.basicConfig(level=logging.INFO)
+transformers_logger = logging.getLogger("transformers")
+transformers_logger.setLevel(logging.WARNING)
+
+
+class ScoreRequest(object):
+    def __init__(self, texts):
+        self.texts = texts
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Coalescer(object):
+    """Merges concurrent /score requests into prediction batches.
+
+    A batch is predicted once it holds max_batch_size texts or max_wait seconds after its first request arrived,
+    whichever comes first.
+    """
+    def __init__(self, model, max_batch_size, max_wait, bucket_size):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.bucket_size = bucket_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=100000)
+        self.requests_num = 0
+        self.texts_num = 0
+        self.batches_num = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def score(self, texts):
+        start = time.time()
+        request = ScoreRequest(texts)
+        self.queue.put(request)
+        request.done.wait()
+        with self.lock:
+            self.latencies.append(time.time() - start)
+            self.requests_num += 1
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            texts_num = len(batch[0].texts)
+            deadline = time.time() + self.max_wait
+            while texts_num < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                texts_num += len(request.texts)
+            self.predict(batch)
+
+    def predict(self, batch):
+        texts = [text for request in batch for text in request.texts]
+        try:
+            predictions = np.atleast_1d(predict(self.model, texts, self.bucket_size)) if texts else []
+            start = 0
+            for request in batch:
+                request.predictions = [float(prediction) for prediction in
+                                       predictions[start:start + len(request.texts)]]
+                start += len(request.texts)
+        except Exception as e:
+            logging.exception('Prediction failed')
+            for request in batch:
+                request.error = e
+        with self.lock:
+            self.texts_num += len(texts)
+            self.batches_num += 1
+        for request in batch:
+            request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {
+                'requests': self.requests_num,
+                'texts': self.texts_num,
+                'batches': self.batches_num,
+                'mean_batch_size': self.texts_num / self.batches_num if self.batches_num else 0,
+            }
+        for percentile in [50, 90, 99]:
+            stats[f'latency_p{percentile}_ms'] = float(np.percentile(latencies, percentile)) if len(latencies) else 0
+        return stats
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # set in main
+    coalescer = None
+    info = {}
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.coalescer.stats())
+        elif self.path == '/info':
+            self.send_json(200, self.info)
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            texts = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['texts']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'Expected JSON body {"texts": [...]}'})
+            return
+        try:
+            self.send_json(200, {'predictions': self.coalescer.score(texts)})
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RemoteModel(object):
+    """Client for a running scoring_server, usable in place of ClassificationModel for prediction."""
+    def __init__(self, url, timeout=3600):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, path, data=None):
+        body = None if data is None else json.dumps(data).encode('utf8')
+        request = urllib.request.Request(self.url + path, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def fingerprint(self):
+        return self.request('/info')['fingerprint']
+
+    def predict(self, to_predict):
+        predictions = np.array(self.request('/score', {'texts': list(to_predict)})['predictions'])
+        return predictions, None
+
+
+def main(args):
+    model = load_model(args)
+    ScoringHandler.coalescer = Coalescer(model, args.max_batch_size, args.max_wait_ms / 1000, args.bucket_size)
+    ScoringHandler.info = {'fingerprint': model_fingerprint(args), 'backend': args.backend}
+    server = ThreadingHTTPServer((args.host, args.port), ScoringHandler)
+    logging.info(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f'Stats: {ScoringHandler.coalescer.stats()}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve standardness predictions over HTTP with a model loaded once.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Host to listen on.')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on.')
+    parser.add_argument('--max_batch_size', type=int, default=256,
+                        help='Maximum number of texts coalesced into one prediction batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=20,
+                        help='Maximum time a request waits for other requests to join its batch.')
+    parser.add_argument('--bucket_size', type=int, default=0,
+                        help='If > 0, predict batches in length-sorted buckets of this size.')
+    add_model_arguments(parser)
+    parser.add_argument('--manual_seed', type=int, default=23,
+                        help='manual seed')
+    args = parser.parse_args()
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))
@@ -1,73 +1,98 @@
 import argparse
 import os
-import sys
+import re
 import time
 
-from simpletransformers.classification import ClassificationModel, ClassificationArgs
-import pandas as pd
 import logging
-from scipy import stats
+
+from run_records import make_record, write_record, RECORD_SUFFIX, RunIndex
 
 
 logging.basicConfig(level=logging.INFO)
 transformers_logger = logging.getLogger("transformers")
 transformers_logger.setLevel(logging.WARNING)
 
-def read_bert(folder_path, folder_name):
-    for file in os.listdir(folder_path):
-        if file.find('test') != -1:
-            with open(os.path.join(folder_path, file), 'r') as f:
-                # ugly I know
+# order of datasets in output file
+OUTPUT_DATASETS = ['reldi-sr', 'reldi-hr', 'janes-norm']
+# first number in both old ((0.71, 1e-05)) and new (PearsonRResult(statistic=np.float64(0.71), ...)) scipy result
+# strings, digits inside names (float64) are skipped
+_RE_NUMBER = re.compile(r'(?<![\w.])(?:nan|-?\d+(?:\.\d*)?(?:e[-+]?\d+)?)')
+
+
+def legacy_dataset(name):
+    # runs used to be told apart by substrings of their folder names
+    if name.find('sr') != -1:
+        return 'reldi-sr'
+    if name.find('hr') != -1:
+        return 'reldi-hr'
+    return 'janes-norm'
+
+
+def legacy_metric(text, prefix):
+    return float(_RE_NUMBER.search(text.split(prefix)[1]).group())
+
+
+def import_legacy(results_path):
+    """Write run records for results of runs made before regression_bert and regression_svm wrote them."""
+    for folder in os.listdir(results_path):
+        folder_path = os.path.join(results_path, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        files = os.listdir(folder_path)
+        if folder.find('svm') == -1:
+            if 'test_results.txt' not in files or folder + RECORD_SUFFIX in files:
+                continue
+            with open(os.path.join(folder_path, 'test_results.txt'), 'r') as f:
                 text = f.read()
-                best_result_pearson = float(text.split('pearsonr = ')[1].split('\n')[0])
-                best_result_spearman = float(text.split('spearmanr = ')[1].split('\n')[0])
-
-    return [[folder_name, str(best_result_pearson), str(best_result_spearman)]]
-
-
-def read_svm(folder_path, folder_name):
-    results = []
-    for file in os.listdir(folder_path):
-        if file[-7:] == '.result':
-            with open(os.path.join(folder_path, file), 'r') as f:
-                text = f.readlines()[0][:-1]
-                pear, spear = text.split('|')
-                results.append([folder_name + '-' + file[:-11], pear.split('=(')[1].split(',')[0], spear.split('correlation=')[1].split(',')[0]])
-
-    return results
+            records = [make_record(folder, 'bert', folder, legacy_dataset(folder), None,
+                                   legacy_metric(text, 'pearsonr = '), legacy_metric(text, 'spearmanr = '), {}, {})]
+        else:
+            records = []
+            for file in files:
+                if file[-7:] != '.result' or file[:-11] + RECORD_SUFFIX in files:
+                    continue
+                with open(os.path.join(folder_path, file), 'r') as f:
+                    pear, spear = f.readline().strip().split('|')
+                records.append(make_record(file[:-11], 'svm', file[:-11], legacy_dataset(folder), None,
+                                           legacy_metric(pear, 'pearson='), legacy_metric(spear, 'spearman='),
+                                           {}, {}))
+        for record in records:
+            logging.info(f'Importing legacy results of {folder}/{record["name"]}')
+            write_record(folder_path, record)
 
 
 def main(args):
-    results = []
-    for folder in os.listdir(args.results_path):
-        folder_path = os.path.join(args.results_path, folder)
-        if os.path.isdir(folder_path):
-            if folder.find('svm') == -1:
-                results += read_bert(folder_path, folder)
-            else:
-                results += read_svm(folder_path, folder)
-
-    # sort by language
-    sr_res = [res for res in results if res[0].find('sr') != -1]
-    hr_res = [res for res in results if res[0].find('hr') != -1]
-    sl_res = [res for res in results if res[0] not in [r[0] for r in sr_res] and res[0] not in [r[0] for r in hr_res]]
-
-    old_res_len = len(results)
-    results = sr_res + hr_res + sl_res
-    assert old_res_len == len(results)
-
+    import_legacy(args.results_path)
+    index = RunIndex(args.index)
+    index.update(args.results_path)
+
+    os.makedirs(os.path.dirname(args.output_file) or '.', exist_ok=True)
+    # svm models of all datasets share names, their rows are named after the output folder as well
+    rows = sorted(index.runs(), key=lambda row: OUTPUT_DATASETS.index(row[3]) if row[3] in OUTPUT_DATASETS
+                  else len(OUTPUT_DATASETS))
     with open(args.output_file, 'w') as f:
-        for res in results:
-            f.write('\t'.join(res) + '\n')
+        for name, family, _, _, pearson, spearman, path in rows:
+            if family == 'svm':
+                name = os.path.basename(os.path.dirname(path)) + '-' + name
+            f.write(f'{name}\t{pearson}\t{spearman}\n')
+
+    if args.readme:
+        print(index.readme_tables())
+    index.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='Walk over results from regression bert and regression svm.')
+        description='Index run records of regression bert and regression svm.')
     parser.add_argument('--results_path', default='data/best_models/',
-                        help='input file in (gz or xml currently). If none, then just database is loaded')
+                        help='Folder searched (recursively) for run records.')
+    parser.add_argument('--index', default='data/outputs/runs.sqlite',
+                        help='SQLite index of run records, only new or changed records are read into it.')
     parser.add_argument('--output_file', default='data/outputs/bert_results.tbl',
-                        help='input file in (gz or xml currently). If none, then just database is loaded')
+                        help='Output file with name (prefixed with folder name for svm models), Pearson and '
+                             'Spearman correlation of latest run of every model, grouped by dataset (sr, hr, sl).')
+    parser.add_argument('--readme', action='store_true',
+                        help='Print results as README tables.')
     args = parser.parse_args()
 
     start = time.time()
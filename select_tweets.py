@@ -1,97 +1,205 @@
 import argparse
-import copy
 import csv
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
 import os
 import time
 import random
 
 
 
+from prediction_cache import connect, select_by_keys
 from submodules.reldi.tokeniser import generate_tokenizer, process, to_text
 
+_worker_tokenizer = None
+
+
+class TokenizationCache(object):
+    """Persistent store of tokenized texts keyed by a hash of tokenizer language, mode and text.
+
+    Stored in SQLite, so it can be shared between workers and reruns (e.g. with another seed).
+    """
+    def __init__(self, path):
+        self.connection = connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, tokens TEXT NOT NULL)')
+        self.connection.commit()
+
+    def get_many(self, keys):
+        return {key: [tuple(token) for token in json.loads(tokens)]
+                for key, tokens in select_by_keys(self.connection, 'tokens', 'tokens', keys)}
+
+    def put_many(self, items):
+        self.connection.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?)',
+                                    [(key, json.dumps(tokens, ensure_ascii=False)) for key, tokens in items])
+        self.connection.commit()
+
 
 class Tokenizer(object):
-    def __init__(self):
+    def __init__(self, cache_path=''):
         self.lang = 'sl'
         self.mode = 'nonstandard'
         self.tokenizer = generate_tokenizer(self.lang)
         self.par_id = 0
+        self.cache = TokenizationCache(cache_path) if cache_path else None
+        self.hits = 0
+        self.misses = 0
 
     def next(self, line):
         return self.form_output(process[self.mode](self.tokenizer, line, self.lang))
 
+    def key(self, text):
+        return hashlib.sha1(f'{self.lang}\t{self.mode}\t{text}'.encode('utf8')).digest()
+
+    def tokenize_many(self, texts):
+        """Tokenize a batch of texts, every distinct one once, and only if it is not cached already."""
+        keys = [self.key(text) for text in texts]
+        found = self.cache.get_many(keys) if self.cache is not None else {}
+        tokenized = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in tokenized:
+                tokenized[key] = self.next(text)
+        self.hits += len(texts) - len(tokenized)
+        self.misses += len(tokenized)
+        if self.cache is not None and tokenized:
+            self.cache.put_many(tokenized.items())
+        found.update(tokenized)
+        return [found[key] for key in keys]
+
     @staticmethod
     def form_output(inp):
         output = []
         space_after = 'SpaceAfter=No'
         previous_token = ''
-        for sent_idx, sent in enumerate(inp):
-            for token_idx, (token, start, end) in enumerate(sent):
-                if not token[0].isspace():
-                    if previous_token:
-                        output.append((previous_token, space_after))
-                    previous_token = token
-                    space_after = 'SpaceAfter=No'
-                else:
-                    space_after = ''
+        for token, _, _ in itertools.chain.from_iterable(inp):
+            if not token[0].isspace():
+                if previous_token:
+                    output.append((previous_token, space_after))
+                previous_token = token
+                space_after = 'SpaceAfter=No'
+            else:
+                space_after = ''
         output.append((previous_token, space_after))
         return output
 
 
+def select_file(args, file, tokenizer):
+    selected_tweets = []
+    hits, misses = tokenizer.hits, tokenizer.misses
+    with open(os.path.join(args.input_folder, file), newline='') as csvfile, open(os.path.join(args.output_folder, file + '.selected'), 'w') as writefile:
+        rows = [row for row in csv.reader(csvfile, delimiter='\t') if row[1] == '']
+        tokens_num = 0
+        enough = False
+        for start in range(0, len(rows), args.tokenize_batch_size):
+            batch = rows[start:start + args.tokenize_batch_size]
+            for row, tokenized in zip(batch, tokenizer.tokenize_many([row[2] for row in batch])):
+                selected_tweets.append((row[0], row[2], tokenized))
+                writefile.write(f"{row[0]}\t{row[2]}\n")
+                tokens_num += len(tokenized)
+                if tokens_num > args.band_tokens_overrides.get(file, args.band_tokens):
+                    print(f"ENOUGH TOKENS IN {file}")
+                    enough = True
+                    break
+            if enough:
+                break
+
+    print(tokens_num)
+    hits, misses = tokenizer.hits - hits, tokenizer.misses - misses
+    print(f'{file}: {hits} of {hits + misses} texts found in tokenization cache')
+    return selected_tweets
+
+
+def plan_files(tweets, files_num):
+    """Assign (band, sid, sent, tokens) tweets to files_num files of near-equal token count and band proportions.
+
+    Tweets of every band are assigned largest first to the file with the fewest tokens of that band (ties go to the
+    file with the fewest tokens overall), so each file gets about the same share of every band.
+    """
+    files = [[] for _ in range(files_num)]
+    totals = [0] * files_num
+    bands = {}
+    for tweet in tweets:
+        bands.setdefault(tweet[0], []).append(tweet)
+    for band_tweets in bands.values():
+        # sort is stable, so equally long tweets keep their shuffled order
+        band_tweets.sort(key=lambda tweet: len(tweet[3]), reverse=True)
+        loads = [(0, totals[i], i) for i in range(files_num)]
+        heapq.heapify(loads)
+        for tweet in band_tweets:
+            band_load, total, i = heapq.heappop(loads)
+            files[i].append(tweet)
+            totals[i] = total + len(tweet[3])
+            heapq.heappush(loads, (band_load + len(tweet[3]), totals[i], i))
+    return files
+
+
+def report_files(files):
+    bands = sorted({tweet[0] for file_tweets in files for tweet in file_tweets})
+    totals = []
+    print('file\ttweets\ttokens\t' + '\t'.join(bands))
+    for file_num, file_tweets in enumerate(files, 1):
+        band_tokens = dict.fromkeys(bands, 0)
+        for band, _, _, tokens in file_tweets:
+            band_tokens[band] += len(tokens)
+        total = sum(band_tokens.values())
+        totals.append(total)
+        print(f'{file_num:02d}\t{len(file_tweets)}\t{total}\t' +
+              '\t'.join(f'{band_tokens[band] / total:.3f}' if total else '0.000' for band in bands))
+    mean = sum(totals) / len(totals)
+    std = (sum((total - mean) ** 2 for total in totals) / len(totals)) ** 0.5
+    print(f'{len(files)} files, tokens per file: mean {mean:.1f}, std {std:.1f}, min {min(totals)}, '
+          f'max {max(totals)}, coefficient of variation {std / mean if mean else 0:.4f}')
+
+
+def init_worker(args):
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(args.cache)
+
+
+def select_file_in_worker(args, file):
+    return select_file(args, file, _worker_tokenizer)
+
+
 def main(args):
     random.seed(args.seed)
 
-    tokenizer = Tokenizer()
-    selected_tweets = []
-    for file in os.listdir(args.input_folder):
-        file_path = os.path.join(args.input_folder, file)
-
-        if os.path.isfile(file_path):
-            with open(file_path, newline='') as csvfile, open(os.path.join(args.output_folder, file + '.selected'), 'w') as writefile:
-                reader = csv.reader(csvfile, delimiter='\t')
-                tokens_num = 0
-                for row in reader:
-                    if row[1] == '':
-                        tokenized = tokenizer.next(row[2])
-                        selected_tweets.append((row[0], row[2], tokenized))
-                        writefile.write(f"{row[0]}\t{row[2]}\n")
-                        tokens_num += len(tokenized)
-                        if (tokens_num > 18000 and file != '0.4-0.5.csv') or tokens_num > 19564:
-                            print(f"ENOUGH TOKENS IN {file}")
-                            break
-
-
-            print(tokens_num)
+    files = [file for file in os.listdir(args.input_folder) if os.path.isfile(os.path.join(args.input_folder, file))]
+    if args.workers > 1:
+        # files keep their order, so that selection and shuffle do not depend on number of workers
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args,)) as pool:
+            selected = pool.starmap(select_file_in_worker, [(args, file) for file in files], chunksize=1)
+    else:
+        tokenizer = Tokenizer(args.cache)
+        selected = [select_file(args, file, tokenizer) for file in files]
+    selected_tweets = [(file, *tweet) for file, file_tweets in zip(files, selected) for tweet in file_tweets]
 
     # shuffle lines
-    shuffled_tweets = copy.deepcopy(selected_tweets)
+    shuffled_tweets = selected_tweets
     random.shuffle(shuffled_tweets)
 
     # store all
     with open(os.path.join(args.output_folder, 'selected_files.tsv'), 'w') as writefile:
-        for sid, sent, _ in shuffled_tweets:
+        for _, sid, sent, _ in shuffled_tweets:
             writefile.write(f"{sid}\t{sent}\n")
 
     # store split data
-    tokens_num = 0
+    total_tokens = sum(len(tokens) for _, _, _, tokens in shuffled_tweets)
+    split_files = plan_files(shuffled_tweets, max(1, round(total_tokens / args.file_tokens)))
     sent_id = 1
-    file_num = 1
-    f = open(os.path.join(args.output_split_data_folder, f'{file_num:02d}'), 'w')
-    for sid, sent, tokens in shuffled_tweets:
-        if tokens_num > 2300:
-            f.close()
-            file_num += 1
-            f = open(os.path.join(args.output_split_data_folder, f'{file_num:02d}'), 'w')
-            tokens_num = 0
-
-        f.write(f'{sent}\n')
-        for tok_id, (token, space_before) in enumerate(tokens):
-            f.write(f'tid.{sid}\t{str(sent_id)}-{str(tok_id+1)}\t{space_before}\t{token}\n')
-        f.write("\n")
-        tokens_num += len(tokens)
-        sent_id += 1
-    f.close()
+    for file_num, file_tweets in enumerate(split_files, 1):
+        # planner orders tweets by length, annotators get them in random order
+        random.shuffle(file_tweets)
+        with open(os.path.join(args.output_split_data_folder, f'{file_num:02d}'), 'w') as f:
+            for _, sid, sent, tokens in file_tweets:
+                f.write(f'{sent}\n')
+                for tok_id, (token, space_before) in enumerate(tokens):
+                    f.write(f'tid.{sid}\t{str(sent_id)}-{str(tok_id+1)}\t{space_before}\t{token}\n')
+                f.write("\n")
+                sent_id += 1
+    report_files(split_files)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -104,7 +212,22 @@ if __name__ == '__main__':
                         help='output file in (gz or xml currently). If none, then just database is loaded')
     parser.add_argument('--seed', type=int, default=23,
                         help='Set manual seed')
+    parser.add_argument('--band_tokens', type=int, default=18000,
+                        help='Tweets are selected from every input file (band) until they exceed this many tokens.')
+    parser.add_argument('--band_tokens_overrides', nargs='*', default=['0.4-0.5.csv:19564'],
+                        help='Token caps of single input files, that differ from --band_tokens, as file:tokens.')
+    parser.add_argument('--file_tokens', type=int, default=2300,
+                        help='Target number of tokens per split file, number of files is total tokens divided by it.')
+    parser.add_argument('--cache', default='data/tokenization_cache.sqlite',
+                        help='Path to SQLite cache of tokenized texts, reruns only tokenize new texts. Empty string '
+                             'disables it.')
+    parser.add_argument('--tokenize_batch_size', type=int, default=256,
+                        help='Number of texts looked up in cache and tokenized at once.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes input files are tokenized in.')
     args = parser.parse_args()
+    args.band_tokens_overrides = {file: int(tokens) for file, tokens in
+                                  (override.rsplit(':', 1) for override in args.band_tokens_overrides)}
 
     start = time.time()
     main(args)
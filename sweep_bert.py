@@ -0,0 +1,213 @@
+import argparse
+import concurrent.futures
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import time
+from argparse import Namespace
+
+import torch
+
+from regression_bert import add_training_arguments, read_data, train
+from run_records import read_record, RECORD_SUFFIX
+
+logging.basicConfig(level=logging.INFO)
+transformers_logger = logging.getLogger("transformers")
+transformers_logger.setLevel(logging.WARNING)
+
+
+class TrialPruned(Exception):
+    pass
+
+
+class MedianPruner(object):
+    """Stops a trial whose dev Spearman after an epoch is below the median of other trials after the same epoch.
+
+    scores maps trial names to their per epoch dev Spearman and is shared between worker processes.
+    """
+    def __init__(self, scores, trial, warmup_epochs, min_trials):
+        self.scores = scores
+        self.trial = trial
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+
+    def __call__(self, epoch, result):
+        spearman = result['spearmanr']
+        # constant predictions have undefined correlation
+        if math.isnan(spearman):
+            spearman = -1.0
+        # values of a manager dict have to be reassigned, not modified in place
+        self.scores[self.trial] = self.scores[self.trial] + [spearman]
+        if epoch <= self.warmup_epochs:
+            return
+        others = [scores[epoch - 1] for trial, scores in self.scores.items()
+                  if trial != self.trial and len(scores) >= epoch]
+        if len(others) < self.min_trials:
+            return
+        median = statistics.median(others)
+        if spearman < median:
+            raise TrialPruned(f'{self.trial}: dev Spearman {spearman:.4f} after epoch {epoch} is below median '
+                              f'{median:.4f} of {len(others)} other trials')
+
+
+def parse_values(values, type):
+    return [type(value) for value in values.split(',')]
+
+
+def trial_configs(args):
+    batch_sizes = parse_values(args.batch_sizes, int)
+    epoch_counts = parse_values(args.epoch_counts, int)
+    seeds = parse_values(args.seeds, int)
+    if args.search == 'grid':
+        return list(itertools.product(parse_values(args.learning_rates, float), batch_sizes, epoch_counts, seeds))
+
+    rng = random.Random(args.manual_seed)
+
+    def learning_rate():
+        # low:high is sampled log-uniformly
+        if ':' in args.learning_rates:
+            low, high = [math.log(float(value)) for value in args.learning_rates.split(':')]
+            return math.exp(rng.uniform(low, high))
+        return rng.choice(parse_values(args.learning_rates, float))
+    return [(learning_rate(), rng.choice(batch_sizes), rng.choice(epoch_counts), rng.choice(seeds))
+            for _ in range(args.trials)]
+
+
+def trial_name(args, config):
+    learning_rate, batch_size, epochs, seed = config
+    return f'{args.name}-lr{learning_rate:.3g}-bs{batch_size}-e{epochs}-s{seed}'
+
+
+def init_worker(jobs):
+    # trials running in parallel share cpu cores
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // jobs))
+
+
+def run_trial(task):
+    args, config, scores = task
+    learning_rate, batch_size, epochs, seed = config
+    name = trial_name(args, config)
+    trial_args = Namespace(**vars(args))
+    trial_args.name = name
+    trial_args.learning_rate = learning_rate
+    trial_args.train_batch_size = batch_size
+    trial_args.epochs = epochs
+    trial_args.manual_seed = seed
+    scores[name] = []
+
+    start = time.time()
+    logging.info(f'Starting trial {name}')
+    try:
+        result = train(trial_args, *read_data(args.input, args.final_prediction),
+                       epoch_callback=MedianPruner(scores, name, args.warmup_epochs, args.min_trials))
+    except TrialPruned as e:
+        logging.info(f'Pruned {e}')
+        # pruned trials would otherwise show up in scrape_results without test results
+        shutil.rmtree(os.path.join(args.model, name), ignore_errors=True)
+        shutil.rmtree(os.path.join(args.best_model, name), ignore_errors=True)
+        return name, None, time.time() - start
+    return name, [name, str(result['pearsonr']), str(result['spearmanr'])], time.time() - start
+
+
+def main(args):
+    configs = []
+    results = []
+    names = set()
+    for config in trial_configs(args):
+        name = trial_name(args, config)
+        if name in names:
+            continue
+        names.add(name)
+        # trials finished by an earlier (interrupted) sweep are not trained again
+        record_path = os.path.join(args.best_model, name, name + RECORD_SUFFIX)
+        if os.path.exists(record_path):
+            logging.info(f'Skipping finished trial {name}')
+            metrics = read_record(record_path)['metrics']
+            results.append([name, str(metrics['pearson']), str(metrics['spearman'])])
+        else:
+            configs.append(config)
+    logging.info(f'Running {len(configs)} trials with {args.jobs} jobs')
+
+    pruned_num = 0
+    if args.jobs > 1:
+        context = multiprocessing.get_context('spawn')
+        # workers of a multiprocessing Pool are daemonic and can not start dataloader worker processes, those of a
+        # ProcessPoolExecutor can
+        with context.Manager() as manager, concurrent.futures.ProcessPoolExecutor(
+                args.jobs, mp_context=context, initializer=init_worker, initargs=(args.jobs,)) as executor:
+            scores = manager.dict()
+            futures = [executor.submit(run_trial, (args, config, scores)) for config in configs]
+            for future in concurrent.futures.as_completed(futures):
+                name, result, duration = future.result()
+                logging.info(f'Trial {name} finished in {duration:.0f}s')
+                if result is None:
+                    pruned_num += 1
+                else:
+                    results.append(result)
+    else:
+        scores = {}
+        for config in configs:
+            name, result, duration = run_trial((args, config, scores))
+            logging.info(f'Trial {name} finished in {duration:.0f}s')
+            if result is None:
+                pruned_num += 1
+            else:
+                results.append(result)
+
+    # same format as scrape_results output, best test Spearman first
+    results.sort(key=lambda result: float(result[2]), reverse=True)
+    output_file = args.output_file or os.path.join('data/outputs', f'{args.name}_sweep.tbl')
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(output_file, 'w') as f:
+        for res in results:
+            f.write('\t'.join(res) + '\n')
+    logging.info(f'{len(results)} trials finished, {pruned_num} pruned, results written to {output_file}')
+    if results:
+        logging.info(f'Best trial: {results[0][0]} - Pearson: {results[0][1]} | Spearman: {results[0][2]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Hyperparameter sweep of BERT normalization regression.')
+    parser.add_argument('input',
+                        help='Path to input files.')
+    parser.add_argument('--name', default='sweep',
+                        help='Prefix of trial names, models of trials are saved as <name>-<hyperparameters>.')
+    parser.add_argument('--search', choices=['grid', 'random'], default='grid',
+                        help='Try all combinations of values below or sample --trials of them.')
+    parser.add_argument('--trials', type=int, default=20,
+                        help='Number of trials of random search.')
+    parser.add_argument('--learning_rates', default='1e-5,2e-5,4e-5',
+                        help='Comma separated learning rates, with random search also low:high range sampled '
+                             'log-uniformly.')
+    parser.add_argument('--batch_sizes', default='16,32',
+                        help='Comma separated train batch sizes.')
+    parser.add_argument('--epoch_counts', default='10',
+                        help='Comma separated numbers of epochs.')
+    parser.add_argument('--seeds', default='23',
+                        help='Comma separated training seeds.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of trials trained in parallel, cpu cores are split between them. With 1 '
+                             'trials are queued.')
+    parser.add_argument('--warmup_epochs', type=int, default=2,
+                        help='Trials are not pruned during their first epochs.')
+    parser.add_argument('--min_trials', type=int, default=3,
+                        help='Minimum number of other trials that reached an epoch, before trials are pruned '
+                             'after it.')
+    parser.add_argument('--output_file',
+                        help='File with results of finished trials, data/outputs/<name>_sweep.tbl by default.')
+    parser.add_argument('--manual_seed', type=int, default=23,
+                        help='Seed of random search.')
+    add_training_arguments(parser)
+    args = parser.parse_args()
+    if args.search == 'grid' and ':' in args.learning_rates:
+        parser.error('Learning rate ranges are only supported with random search.')
+
+    start = time.time()
+    main(args)
+    logging.info("TIME: {}".format(time.time() - start))